@@ -1,27 +1,42 @@
-from collections import defaultdict
-from Utils import Variable, CommitValue, TempValue, RW_Result, InvalidCommandError
-from Locks import Lock, ReadLock, WriteLock, LockType, VarLockManager
+import os
+from collections import defaultdict, OrderedDict
+from Utils import Variable, CommitValue, TempValue, RW_Result, InvalidCommandError, VARIABLE_IDS, TRANSACTION_IDS, \
+    named_graph
+from Locks import Lock, ReadLock, WriteLock, LockType, LockQueue, VarLockManager, SiteLockManager, IntentLockType, \
+    DEFAULT_ESCALATION_THRESHOLD
+
+DEFAULT_HOT_VERSIONS = 64 # versions per variable kept in memory when a version store is used
 
 
 # A DataManager represents a site, where all variables and locks would be stored here.
 class DataManager:
 
-    def __init__(self, site_id: int):
+    def __init__(self, site_id: int, escalation_threshold = DEFAULT_ESCALATION_THRESHOLD, version_store_path = None,
+                 hot_versions = DEFAULT_HOT_VERSIONS):
         """
         Initialize DataManager Object
         Initialize variables in each site, create data table and lock table
         :param site_id: id of this site
+        :param escalation_threshold: number of variable locks after which a transaction escalates to a site lock, None disables
+        :param version_store_path: directory for cold version segments, None keeps all versions in memory
+        :param hot_versions: max number of versions per variable kept in memory when version_store_path is set
         """
         self.is_up = True
         self.site_id = site_id
         self.data_table = {} # {variable id: Variable}
         self.lock_table = {} # {variable id: VarLockManager}
+        self.site_lock_manager = SiteLockManager(site_id, escalation_threshold) # intent / escalated locks of this site
         self.fail_time_list = [] # latest fail time will be append at tail
         self.recover_time_list = [] # latest recover time will be append at tail
+        self.catch_up_queue = [] # replicated variables waiting to catch up from peers after recovery
+        self.catch_up_versions_copied = 0 # number of CommitValue copied from peers, measures catch-up bandwidth
+        self.catch_up_done_ts = None # time when last catch-up finished, None while catching up or never recovered
+        self.change_log = OrderedDict() # {variable id: time of last change}, most recently changed at the tail
+        self.status_change_ts = 0 # time of last fail / recover of this site
 
         # add all variables which belong to this site
-        for num in range(1,21):
-            var_id = 'x' + str(num)
+        for var_id in range(len(VARIABLE_IDS)):
+            num = var_id + 1
             # Even indexed variables are at all sites
             if num%2 == 0:
                 self.lock_table[var_id] = VarLockManager(var_id)
@@ -31,11 +46,18 @@ class DataManager:
                 self.lock_table[var_id] = VarLockManager(var_id)
                 self.data_table[var_id] = Variable(var_id, CommitValue(10*num, 0), False)
 
+        # older versions of each variable spill to site_<id>/<variable id>.seg under version_store_path
+        if version_store_path is not None:
+            site_path = os.path.join(version_store_path, "site_{}".format(site_id))
+            os.makedirs(site_path, exist_ok=True)
+            for var_id, variable in self.data_table.items():
+                variable.enable_spill(os.path.join(site_path, VARIABLE_IDS.names[var_id] + ".seg"), hot_versions)
+
 
-    def has_variable(self, variable_id: str):
+    def has_variable(self, variable_id: int):
         """
         Judge whether a variable id exists in this site
-        :param variable_id: id of the variable, like x3
+        :param variable_id: dense id of the variable, 2 for x3
         :return: True means variable_id exists, False means not exist
         """
         return variable_id in self.data_table
@@ -51,14 +73,79 @@ class DataManager:
         lock_info = "site {} [{}] lock info - ".format(self.site_id, status)
 
         for variable in self.data_table.values():
-            site_info += "{}: {}, ".format(variable.variable_id, variable.get_latest_commit_value())
+            variable_name = VARIABLE_IDS.names[variable.variable_id]
+            site_info += "{}: {}, ".format(variable_name, variable.get_latest_commit_value())
             current_lock = self.lock_table.get(variable.variable_id).cur_lock
-            if current_lock: lock_info += "{}: {}, ".format(variable.variable_id, current_lock)
+            if current_lock: lock_info += "{}: {}, ".format(variable_name, current_lock)
+        for transaction_id, modes in self.site_lock_manager.granted.items():
+            if self.site_lock_manager.is_escalated(transaction_id):
+                lock_info += "site lock {}: {}, ".format(TRANSACTION_IDS.names[transaction_id],
+                                                         sorted(mode.name for mode in modes))
         print(site_info)
         print(lock_info)
 
 
-    def read(self, transaction_id: str, variable_id: str):
+    def mark_changed(self, variable_id: int, change_ts: int):
+        """
+        Record that committed value or readability of a variable changed, keeps change_log ordered by time
+        :param variable_id: id of the changed variable
+        :param change_ts: time of the change
+        """
+        self.change_log.pop(variable_id, None)
+        self.change_log[variable_id] = change_ts
+
+
+    def changed_since(self, since_ts: int):
+        """
+        Find variables changed at or after a timestamp, walking change_log from the tail
+        Cost is proportional to the number of changed variables, not the number of variables
+        :param since_ts: timestamp
+        :return: list of variable ids, in the order they changed
+        """
+        changed = []
+        for variable_id in reversed(self.change_log):
+            if self.change_log[variable_id] < since_ts: break
+            changed.append(variable_id)
+        return changed[::-1]
+
+
+    def dump_structured(self, variable_ids = None, since_ts = None):
+        """
+        Machine-readable dump of this site, restricted by variable ids and / or change time
+        :param variable_ids: only dump these variables, None means all variables
+        :param since_ts: only dump variables changed at or after this time, None means no restriction
+        :return: dict with site status, and value / readability / current lock of each dumped variable, by name
+        """
+        if since_ts is not None:
+            candidates = self.changed_since(since_ts)
+        elif variable_ids is not None:
+            # keep data_table order, variable_ids is a set
+            candidates = [variable_id for variable_id in self.data_table if variable_id in variable_ids]
+        else:
+            candidates = self.data_table
+        if since_ts is not None and variable_ids is not None:
+            candidates = [variable_id for variable_id in candidates if variable_id in variable_ids]
+
+        variables = {}
+        for variable_id in candidates:
+            variable: Variable = self.data_table.get(variable_id)
+            if not variable: continue
+            current_lock = self.lock_table[variable_id].cur_lock
+            lock = None
+            if current_lock:
+                holders = current_lock.transaction_ids
+                lock = {"type": current_lock.lock_type.name,
+                        "transactions": sorted(TRANSACTION_IDS.names_of(holders)) if isinstance(holders, set)
+                                        else [TRANSACTION_IDS.names[holders]]}
+            variables[VARIABLE_IDS.names[variable_id]] = {"value": variable.get_latest_commit_value(),
+                                      "readable": variable.is_readable, "lock": lock}
+        site_info = {"site": self.site_id, "up": self.is_up, "variables": variables}
+        if since_ts is None or self.status_change_ts >= since_ts:
+            site_info["status_changed_at"] = self.status_change_ts
+        return site_info
+
+
+    def read(self, transaction_id: int, variable_id: int):
         """
         A transaction T want to read a variable i from this site
         First judge the current lock type on this variable, then try to get read lock of this variable
@@ -73,25 +160,39 @@ class DataManager:
         current_lock = var_lock_manager.cur_lock
         if not variable.is_readable: return RW_Result(False)
 
+        # transaction holds an escalated S/X site lock, no variable lock is needed
+        if self.site_lock_manager.is_escalated(transaction_id):
+            if variable.temp_value and variable.temp_value.transaction_id == transaction_id:
+                return RW_Result(True, variable.get_temp_value())
+            return RW_Result(True, variable.get_latest_commit_value())
+        # intent lock on site must be obtained before any variable lock
+        if not self.site_lock_manager.acquire(transaction_id, IntentLockType.IS):
+            return RW_Result(False)
+
         # currently, var has been locked
         if current_lock:
 
             if current_lock.lock_type == LockType.R:
                 # current transaction already get a read lock on var
                 if transaction_id in current_lock.transaction_ids:
+                    self.register_variable_lock(transaction_id, variable_id)
                     return RW_Result(True, variable.get_latest_commit_value())
                 # check if there is queued write lock, if not, share read lock with existing transactions
                 if not var_lock_manager.has_queued_write_lock():
                     var_lock_manager.share_read_lock(transaction_id)
+                    self.register_variable_lock(transaction_id, variable_id)
                     return RW_Result(True, variable.get_latest_commit_value())
                 # there is queued write lock, can not skip it to obtain read lock, add this read lock to lock queue
                 var_lock_manager.add_lock_to_queue(ReadLock(variable_id, transaction_id, True))
                 return RW_Result(False)
 
             elif current_lock.lock_type == LockType.W:
-                # current transaction already get a write lock on var, temp value has been written
+                # current transaction already get a write lock on var
                 if current_lock.transaction_ids == transaction_id:
-                    return RW_Result(True, variable.get_temp_value())
+                    # the lock may come from the queue before its write executes, then nothing is written yet
+                    if variable.temp_value and variable.temp_value.transaction_id == transaction_id:
+                        return RW_Result(True, variable.get_temp_value())
+                    return RW_Result(True, variable.get_latest_commit_value())
                 # other transaction is holding a write lock on var, add this read lock to lock queue
                 else:
                     var_lock_manager.add_lock_to_queue(ReadLock(variable_id, transaction_id, True))
@@ -100,10 +201,45 @@ class DataManager:
         # var has no lock on it
         else:
             var_lock_manager.cur_lock = ReadLock(variable_id,transaction_id)
+            self.register_variable_lock(transaction_id, variable_id)
             return RW_Result(True, variable.get_latest_commit_value())
 
 
-    def read_snapshot(self, variable_id: str, begin_ts: int):
+    def cancel_queued_read(self, transaction_id: int, variable_id: int, still_pending = ()):
+        """
+        Remove a queued read lock, after the transaction has read this variable from another site
+        Once no read of this transaction waits on this site anymore, stop its IS wait, so it leaves no wait-for edge,
+        and release its IS lock if it guards no variable lock, so it does not block escalation until commit
+        :param transaction_id: id of this transaction
+        :param variable_id: id of the variable
+        :param still_pending: ids of variables the same operation still waits for, e.g. rest of a batch read
+        """
+        self.lock_table[variable_id].lock_queue.remove(transaction_id, LockType.R)
+        if any(pending_id in self.data_table for pending_id in still_pending):
+            return
+        self.site_lock_manager.cancel_wait(transaction_id, IntentLockType.IS)
+        if not any(lock_mgr.lock_queue.has(transaction_id, LockType.R) for lock_mgr in self.lock_table.values()):
+            self.site_lock_manager.release_unused_intent(transaction_id)
+
+
+    def read_batch(self, transaction_id: int, variable_ids):
+        """
+        A transaction T want to read several variables from this site in one pass
+        Variables which this site doesn't have are skipped
+        :param transaction_id: id of this transaction which wants to do read
+        :param variable_ids: ids of variables which this transaction wants to read
+        :return: {variable id: value} for all variables successfully read from this site
+        """
+        values = {}
+        for variable_id in variable_ids:
+            if variable_id not in self.data_table: continue
+            return_result = self.read(transaction_id, variable_id)
+            if return_result.success:
+                values[variable_id] = return_result.value
+        return values
+
+
+    def read_snapshot(self, variable_id: int, begin_ts: int):
         """
         A read-only transaction T want to read a variable i from this site
         :param variable_id: id of variable which this transaction wants to read from
@@ -113,72 +249,126 @@ class DataManager:
         variable: Variable = self.data_table[variable_id]
         if variable.is_readable:
             # get the latest commit before transaction's begin time
-            # our latest commit value exist in the tail of commit queue
-            for commit_value in variable.commit_queue[::-1]:
-                # we found the snapshot
-                if commit_value.commit_ts <= begin_ts:
-                    if variable.is_replicated:
-                        for fail_time in self.fail_time_list:
-                            # if site ever failed after the commit and before the transaction's begin time
-                            # this snapshot is invalid
-                            if commit_value.commit_ts < fail_time <= begin_ts:
-                                return RW_Result(False)
-                    return RW_Result(True, commit_value.value)
+            commit_value = variable.get_snapshot_version(begin_ts)
+            # we found the snapshot
+            if commit_value:
+                if variable.is_replicated:
+                    for fail_time in self.fail_time_list:
+                        # if site ever failed after the commit and before the transaction's begin time
+                        # this snapshot is invalid, unless the variable caught up from a peer after that failure
+                        if commit_value.commit_ts < fail_time <= begin_ts and \
+                                not fail_time <= variable.catch_up_ts <= begin_ts:
+                            return RW_Result(False)
+                return RW_Result(True, commit_value.value)
         return RW_Result(False)
 
 
-    def can_get_write_lock(self, transaction_id: str, variable_id: str):
+    def check_write_lock(self, transaction_id: int, variable_id: int):
         """
-        Judge whether write lock of variable_id can be obtained from this site
+        Judge whether write lock of variable_id can be obtained from this site, without changing any lock state
+        Used as first phase of replicated write, locks are queued only after all replicas have been checked
         :param transaction_id: id of this transaction
         :param variable_id: id of variable which T wants to write
         :return: True / False means can/can't get write lock
         """
-
-        variable: Variable = self.data_table.get(variable_id)
         var_lock_manager: VarLockManager = self.lock_table.get(variable_id)
-
         current_lock = var_lock_manager.cur_lock
 
+        # transaction holds an escalated X site lock, no variable lock is needed
+        if self.site_lock_manager.holds_exclusive(transaction_id):
+            return True
+        # intent lock on site must be obtainable before any variable lock
+        if not self.site_lock_manager.covers(transaction_id, IntentLockType.IX) and \
+                self.site_lock_manager.conflicting_holders(transaction_id, IntentLockType.IX):
+            return False
+
         # currently, var has been locked
         if current_lock:
 
             if current_lock.lock_type == LockType.R:
                 # current transaction already get a read lock on var, judge whether it is shared
                 if len(current_lock.transaction_ids)>1: # shared with other T, can not write
-                    var_lock_manager.add_lock_to_queue(WriteLock(variable_id, transaction_id, True))
                     return False
                 if transaction_id not in current_lock.transaction_ids: # hold by other T, can not write
-                    var_lock_manager.add_lock_to_queue(WriteLock(variable_id, transaction_id, True))
                     return False
 
                 # read lock hold only by this transaction, try to promote its lock from read to write
-
                 # have other T's queued write lock, can not skip
-                if var_lock_manager.has_queued_write_lock(transaction_id):
-                    var_lock_manager.add_lock_to_queue(WriteLock(variable_id, transaction_id, True))
-                    return False
-                # can promote read lock to write lock
-                return True
+                return not var_lock_manager.has_queued_write_lock(transaction_id)
 
             elif current_lock.lock_type == LockType.W:
                 # current transaction already get a write lock on var, temp value has been written
-                if current_lock.transaction_ids == transaction_id:
-                    return True
-                # other transaction is holding a write lock on var, can not write
-                else:
-                    var_lock_manager.add_lock_to_queue(WriteLock(variable_id, transaction_id, True))
-                    return False
+                return current_lock.transaction_ids == transaction_id
 
         # var has no lock on it
-        else:
+        return True
+
+
+    def write_lock_blockers(self, transaction_id: int, variable_id: int):
+        """
+        Find transactions which keep write lock of variable_id from this transaction on this site
+        Same conditions as check_write_lock, a new request would also wait behind every queued lock
+        :param transaction_id: id of this transaction
+        :param variable_id: id of variable which T wants to write
+        :return: set of transaction ids, empty if write lock can be obtained
+        """
+        if self.site_lock_manager.holds_exclusive(transaction_id):
+            return set()
+        if not self.site_lock_manager.covers(transaction_id, IntentLockType.IX):
+            site_blockers = self.site_lock_manager.conflicting_holders(transaction_id, IntentLockType.IX)
+            if site_blockers: return site_blockers
+        if self.check_write_lock(transaction_id, variable_id):
+            return set()
+        var_lock_manager: VarLockManager = self.lock_table[variable_id]
+        current_lock = var_lock_manager.cur_lock
+        blockers = {LockQueue.queued_transaction_id(lock) for lock in var_lock_manager.lock_queue}
+        if current_lock:
+            blockers |= current_lock.transaction_ids if current_lock.lock_type == LockType.R else {current_lock.transaction_ids}
+        blockers.discard(transaction_id)
+        return blockers
+
+
+    def queue_write_lock(self, transaction_id: int, variable_id: int):
+        """
+        Queue write lock of variable_id after check_write_lock refused it on this site
+        If the site lock is what blocks us, transaction waits at site level instead of in variable lock queue
+        :param transaction_id: id of this transaction
+        :param variable_id: id of variable which T wants to write
+        """
+        if not self.site_lock_manager.acquire(transaction_id, IntentLockType.IX):
+            return
+        self.lock_table[variable_id].add_lock_to_queue(WriteLock(variable_id, transaction_id, True))
+
+
+    def can_get_write_lock(self, transaction_id: int, variable_id: int):
+        """
+        Judge whether write lock of variable_id can be obtained from this site, queue it if not
+        :param transaction_id: id of this transaction
+        :param variable_id: id of variable which T wants to write
+        :return: True / False means can/can't get write lock
+        """
+        if self.check_write_lock(transaction_id, variable_id):
             return True
+        self.queue_write_lock(transaction_id, variable_id)
+        return False
+
+
+    def check_write_locks(self, transaction_id: int, variable_ids):
+        """
+        Judge which write locks of several variables can be obtained from this site in one pass, without queueing
+        Variables which this site doesn't have are skipped
+        :param transaction_id: id of this transaction
+        :param variable_ids: ids of variables which T wants to write
+        :return: set of variable ids whose write lock can be obtained
+        """
+        return {variable_id for variable_id in variable_ids
+                if variable_id in self.data_table and self.check_write_lock(transaction_id, variable_id)}
 
 
-    def write(self, transaction_id: str, variable_id: str, value: int):
+    def write(self, transaction_id: int, variable_id: int, value: int):
         """
         A transaction T want to write a variable i to value V in this site
-        As write operation would be first judged by can_get_write_lock, so when we do write,
+        As write operation would be first judged by check_write_lock on all replicas, so when we do write,
         all write lock can must be obtained, we can safely write value to var and set new write lock.
         :param transaction_id: id of this transaction
         :param variable_id: id of variable which T wants to write
@@ -190,12 +380,39 @@ class DataManager:
 
         # Write value to temp_value of var, which will be committed when T commit
         variable.temp_value = TempValue(value, transaction_id)
+        # X site lock already covers this variable
+        if self.site_lock_manager.holds_exclusive(transaction_id):
+            return RW_Result(True)
+        self.site_lock_manager.acquire(transaction_id, IntentLockType.IX)
         # Safely set new lock to this write lock
         var_lock_manager.cur_lock = WriteLock(variable_id, transaction_id)
+        self.register_variable_lock(transaction_id, variable_id)
         return RW_Result(True)
 
 
-    def abort(self, transaction_id: str):
+    def register_variable_lock(self, transaction_id: int, variable_id: int):
+        """
+        Record a newly obtained variable lock in site lock manager
+        Once transaction holds too many variable locks on this site, escalate them into one site lock:
+        X if the transaction has written on this site, S otherwise. Its variable locks are then released.
+        :param transaction_id: id of the transaction
+        :param variable_id: id of the variable just locked
+        """
+        if not self.site_lock_manager.record_variable_lock(transaction_id, variable_id):
+            return
+        has_written = IntentLockType.IX in self.site_lock_manager.granted[transaction_id]
+        escalated_lock = IntentLockType.X if has_written else IntentLockType.S
+        covered_variables = self.site_lock_manager.try_escalate(transaction_id, escalated_lock)
+        if covered_variables is None:
+            return
+        print("{} escalates to {} lock on site {}".format(TRANSACTION_IDS.names[transaction_id], escalated_lock.name, self.site_id))
+        # a write lock always comes with IX, so an S escalation never covers a written variable
+        for covered_variable_id in covered_variables:
+            self.lock_table[covered_variable_id].release_lock_held_by_transaction(transaction_id)
+        self.update_lock_table()
+
+
+    def abort(self, transaction_id: int):
         """
         A transaction abort, release all current locks / queued locks held by it
         :param transaction_id: id of the transaction to be aborted
@@ -204,18 +421,20 @@ class DataManager:
         for lock_mgr in self.lock_table.values():
             lock_mgr.release_lock_held_by_transaction(transaction_id)
             # release all queued lock for this transaction
-            for lock in list(lock_mgr.lock_queue):
-                # queued lock can only have 1 transaction on it
-                if lock.lock_type == LockType.R and transaction_id in lock.transaction_ids:
-                    lock_mgr.lock_queue.remove(lock)
-                if lock.lock_type == LockType.W and transaction_id == lock.transaction_ids:
-                    lock_mgr.lock_queue.remove(lock)
+            lock_mgr.remove_queued_locks(transaction_id)
+
+        # discard its uncommitted writes, otherwise a transaction which begins again with this id would commit them
+        for variable in self.data_table.values():
+            if variable.temp_value and variable.temp_value.transaction_id == transaction_id:
+                variable.temp_value = None
+
+        self.site_lock_manager.release_transaction(transaction_id)
 
         # update lock table.
         self.update_lock_table()
 
 
-    def commit(self, transaction_id: str, commit_ts: int):
+    def commit(self, transaction_id: int, commit_ts: int):
         """
         A transaction commit, release all current lock held by it. Commit all temp value to commit queue
         If this transaction has queued lock, we can not commit it with queued locks
@@ -226,18 +445,18 @@ class DataManager:
         for lock_mgr in self.lock_table.values():
             lock_mgr.release_lock_held_by_transaction(transaction_id)
             # detect whether there is queued lock for this transaction
-            for lock in lock_mgr.lock_queue:
-                # queued lock can only have 1 transaction on it
-                if lock.lock_type == LockType.R and transaction_id in lock.transaction_ids:
-                    raise RuntimeError("{} cannot commit with queued locks: {}".format(transaction_id, lock))
-                if lock.lock_type == LockType.W and transaction_id == lock.transaction_ids:
-                    raise RuntimeError("{} cannot commit with queued locks: {}".format(transaction_id, lock))
+            if lock_mgr.has_queued_lock(transaction_id):
+                raise RuntimeError("{} cannot commit with queued locks: {}".format(TRANSACTION_IDS.names[transaction_id],
+                                                                                  lock_mgr.lock_queue))
 
         # update commit queue
         for variable in self.data_table.values():
             if variable.temp_value and variable.temp_value.transaction_id == transaction_id:
                 variable.add_commit_value(CommitValue(variable.temp_value.value, commit_ts))
                 variable.is_readable = True
+                self.mark_changed(variable.variable_id, commit_ts)
+
+        self.site_lock_manager.release_transaction(transaction_id)
 
         # update lock table.
         self.update_lock_table()
@@ -252,8 +471,11 @@ class DataManager:
             raise InvalidCommandError("Trying to fail a down site!")
         self.is_up = False
         self.fail_time_list.append(fail_ts)
+        self.status_change_ts = fail_ts
+        self.catch_up_queue = []
         for var_lock_manager in self.lock_table.values():
             var_lock_manager.reset()
+        self.site_lock_manager.reset()
 
 
     def recover(self, recover_ts: int):
@@ -269,6 +491,75 @@ class DataManager:
             # replicated variable (even index) not readable when site recover
             if variable.is_replicated:
                 variable.is_readable = False
+                self.mark_changed(variable.variable_id, recover_ts)
+        self.status_change_ts = recover_ts
+        self.catch_up_queue = [variable.variable_id for variable in self.data_table.values() if variable.is_replicated]
+        self.catch_up_done_ts = None
+
+
+    def has_pending_write(self, variable_id: int):
+        """
+        Judge whether an active transaction has written a variable on this site but not committed yet
+        :param variable_id: id of the variable
+        :return: True means there is an uncommitted write on this variable
+        """
+        current_lock = self.lock_table[variable_id].cur_lock
+        if current_lock and current_lock.lock_type == LockType.W:
+            return True
+        # writes under an escalated X site lock leave no variable lock
+        temp_value = self.data_table[variable_id].temp_value
+        return temp_value is not None and self.site_lock_manager.holds_exclusive(temp_value.transaction_id)
+
+
+    def catch_up(self, peers, catch_up_ts: int, budget: int):
+        """
+        After recovery, copy missed commits of replicated variables from up peers, so they become readable
+        without waiting for a new committed write. A variable is copied only from a peer where it is readable,
+        and only when no up site holds an uncommitted write on it, as such a write may not have reached this site.
+        :param peers: all other sites
+        :param catch_up_ts: timestamp of this catch-up step
+        :param budget: at most this number of variables are copied in this step
+        :return: number of variables which became readable in this step
+        """
+        up_peers = [peer for peer in peers if peer.is_up and peer is not self]
+        caught_up = 0
+        for variable_id in list(self.catch_up_queue):
+            if caught_up >= budget: break
+            variable: Variable = self.data_table[variable_id]
+            # already readable again because of a committed write
+            if variable.is_readable:
+                self.catch_up_queue.remove(variable_id)
+                continue
+            if self.has_pending_write(variable_id) or any(peer.has_pending_write(variable_id) for peer in up_peers):
+                continue
+            source = next((peer for peer in up_peers if peer.data_table[variable_id].is_readable), None)
+            if not source: continue
+
+            latest_ts = variable.commit_queue[-1].commit_ts
+            missed = source.data_table[variable_id].versions_after(latest_ts)
+            for commit_value in missed:
+                variable.add_commit_value(CommitValue(commit_value.value, commit_value.commit_ts))
+            variable.catch_up_ts = catch_up_ts
+            variable.is_readable = True
+            self.mark_changed(variable_id, catch_up_ts)
+            self.catch_up_versions_copied += len(missed)
+            self.catch_up_queue.remove(variable_id)
+            caught_up += 1
+            print("site {} caught up {} from site {}, copied {} versions".format(self.site_id, VARIABLE_IDS.names[variable_id],
+                                                                                 source.site_id, len(missed)))
+
+        if not self.catch_up_queue and self.catch_up_done_ts is None:
+            self.catch_up_done_ts = catch_up_ts
+        return caught_up
+
+
+    def catch_up_latency(self):
+        """
+        Time from last recovery until all replicated variables became readable again
+        :return: number of ticks, None if catch-up is not finished
+        """
+        if self.catch_up_done_ts is None or not self.recover_time_list: return None
+        return self.catch_up_done_ts - self.recover_time_list[-1]
 
 
     def update_lock_table(self):
@@ -289,7 +580,7 @@ class DataManager:
                 if lock_mgr.cur_lock.lock_type == LockType.R:
                     while lock_mgr.lock_queue:
                         # fetch queued lock one by one
-                        next_lock = lock_mgr.lock_queue[0]
+                        next_lock = lock_mgr.lock_queue.peek()
                         # successive read lock, can share
                         if next_lock.lock_type == LockType.R:
                             lock_mgr.share_read_lock(list(next_lock.transaction_ids)[0])
@@ -337,7 +628,7 @@ class DataManager:
 
         for var_lock_manager in self.lock_table.values():
             current_lock = var_lock_manager.cur_lock
-            lock_queue = var_lock_manager.lock_queue
+            lock_queue = list(var_lock_manager.lock_queue)
 
             if current_lock:
                 # Calculate wait-for between current lock and queued lock
@@ -349,5 +640,9 @@ class DataManager:
                     for i in range(j):
                         check(lock_queue[i],lock_queue[j])
 
-        if len(wait_for_graph.keys())>0: print("wait-for graph for site {}: {}".format(self.site_id, wait_for_graph))
+        # Calculate wait-for between blocked intent lock requests and site lock holders
+        for waiter, blockers in self.site_lock_manager.waiters.items():
+            wait_for_graph[waiter] |= blockers
+
+        if len(wait_for_graph.keys())>0: print("wait-for graph for site {}: {}".format(self.site_id, named_graph(wait_for_graph)))
         return wait_for_graph
@@ -1,5 +1,6 @@
 from enum import Enum, unique
-from collections import deque
+from collections import OrderedDict, defaultdict
+from Utils import VARIABLE_IDS, TRANSACTION_IDS
 
 
 ############################################################
@@ -14,7 +15,7 @@ class LockType(Enum):
 
 class Lock:
 
-    def __init__(self, variable_id: str, is_queued: bool, lock_type: LockType):
+    def __init__(self, variable_id: int, is_queued: bool, lock_type: LockType):
         """
         Initialize a Lock Object, it has 2 subclasses ReadLock and WriteLock
         :param variable_id: id of variable which this lock belongs to
@@ -31,12 +32,15 @@ class Lock:
         """
         Output lock object info
         """
-        return "Lock [{}, {}, {}, {}]".format(self.variable_id, self.transaction_ids, self.lock_type, self.is_queued)
+        transaction_names = TRANSACTION_IDS.names_of(self.transaction_ids) if self.lock_type == LockType.R \
+            else TRANSACTION_IDS.names[self.transaction_ids]
+        return "Lock [{}, {}, {}, {}]".format(VARIABLE_IDS.names[self.variable_id], transaction_names,
+                                              self.lock_type, self.is_queued)
 
 
 class ReadLock(Lock):
 
-    def __init__(self, variable_id: str, transaction_id: str, is_queued = False):
+    def __init__(self, variable_id: int, transaction_id: int, is_queued = False):
         """
         Inherit from Lock
         :param variable_id: id of variable which this lock belongs to
@@ -49,7 +53,7 @@ class ReadLock(Lock):
 
 class WriteLock(Lock):
 
-    def __init__(self, variable_id: str, transaction_id: str, is_queued = False):
+    def __init__(self, variable_id: int, transaction_id: int, is_queued = False):
         """
         Inherit from Lock
         :param variable_id: id of variable which this lock belongs to
@@ -60,16 +64,103 @@ class WriteLock(Lock):
         self.transaction_ids = transaction_id # There can only be 1 Write lock on 1 var, so didn't use set
 
 
+class LockQueue:
+
+    def __init__(self):
+        """
+        Initialize LockQueue Object, a FIFO queue of locks indexed by (transaction id, lock type)
+        A transaction has at most 1 queued lock of each type on a variable, so the key is unique
+        Supports O(1) append, popleft, duplicate detection and removal of a transaction's queued locks
+        """
+        # lock type is keyed by its int value, hashing an Enum member runs Python code
+        self.queue = OrderedDict() # {(transaction id, LockType value): Lock}, keeps FIFO order
+        self.write_count = 0 # number of queued write locks
+
+
+    @staticmethod
+    def queued_transaction_id(lock: Lock):
+        """
+        Get the id of the only transaction of a queued lock
+        :param lock: a queued ReadLock or WriteLock
+        """
+        if lock.lock_type == LockType.R:
+            return next(iter(lock.transaction_ids))
+        return lock.transaction_ids
+
+
+    def __len__(self):
+        return len(self.queue)
+
+
+    def __iter__(self):
+        return iter(self.queue.values())
+
+
+    def __repr__(self):
+        return "LockQueue {}".format(list(self.queue.values()))
+
+
+    def has(self, transaction_id: int, lock_type: LockType):
+        """
+        Judge whether a transaction has a queued lock of this type
+        """
+        return (transaction_id, lock_type.value) in self.queue
+
+
+    def append(self, lock: Lock):
+        """
+        Add a lock at the tail of the queue
+        """
+        self.queue[(self.queued_transaction_id(lock), lock.lock_type.value)] = lock
+        if lock.lock_type == LockType.W:
+            self.write_count += 1
+
+
+    def peek(self):
+        """
+        Get the lock at the head of the queue without removing it
+        """
+        return next(iter(self.queue.values()))
+
+
+    def popleft(self):
+        """
+        Remove and return the lock at the head of the queue
+        """
+        _, lock = self.queue.popitem(last=False)
+        if lock.lock_type == LockType.W:
+            self.write_count -= 1
+        return lock
+
+
+    def remove(self, transaction_id: int, lock_type: LockType):
+        """
+        Remove the queued lock of a transaction with this type, if any
+        """
+        lock = self.queue.pop((transaction_id, lock_type.value), None)
+        if lock and lock_type == LockType.W:
+            self.write_count -= 1
+
+
+    def remove_transaction(self, transaction_id: int):
+        """
+        Remove all queued locks of a transaction
+        """
+        self.queue.pop((transaction_id, LockType.R.value), None)
+        if self.queue.pop((transaction_id, LockType.W.value), None):
+            self.write_count -= 1
+
+
 class VarLockManager:
 
-    def __init__(self, variable_id: str):
+    def __init__(self, variable_id: int):
         """
         Initialize VarLockManager Object
         :param variable_id: indicate this lock manager belong to which variable
         """
         self.variable_id = variable_id
         self.cur_lock: Lock = None # cuurent lock on this variable, can be ReadLock or WriteLock
-        self.lock_queue = deque() # a queue to store all failed attempted lock
+        self.lock_queue = LockQueue() # a queue to store all failed attempted lock
 
 
     def reset(self):
@@ -78,7 +169,7 @@ class VarLockManager:
         :return:
         """
         self.cur_lock = None
-        self.lock_queue = deque()
+        self.lock_queue = LockQueue()
 
 
     def has_queued_write_lock(self, exclude_transaction_id = None):
@@ -87,12 +178,10 @@ class VarLockManager:
         :param exclude_transaction_id: if exclude_transaction_id is passed in, ignore locks belogn to this transaction
         :return: True/False means whether there is queued write lock
         """
-        for lock in self.lock_queue:
-            if lock.lock_type == LockType.W:
-                if exclude_transaction_id and lock.transaction_ids == exclude_transaction_id:
-                    continue
-                return True
-        return False
+        write_count = self.lock_queue.write_count
+        if exclude_transaction_id is not None and self.lock_queue.has(exclude_transaction_id, LockType.W):
+            write_count -= 1
+        return write_count > 0
 
 
     def add_lock_to_queue(self, lock_to_add: Lock):
@@ -103,14 +192,31 @@ class VarLockManager:
         (2) lock_to_add is ReadLock, and the WriteLock of same transaction and var already exists
         :param lock_to_add: the lock waited to be added
         """
-        for lock in self.lock_queue:
-            if lock.transaction_ids == lock_to_add.transaction_ids:
-                if lock.lock_type == lock_to_add.lock_type or lock_to_add.lock_type == LockType.R:
-                    return
+        transaction_id = LockQueue.queued_transaction_id(lock_to_add)
+        if self.lock_queue.has(transaction_id, lock_to_add.lock_type):
+            return
+        if lock_to_add.lock_type == LockType.R and self.lock_queue.has(transaction_id, LockType.W):
+            return
         self.lock_queue.append(lock_to_add)
 
 
-    def share_read_lock(self, transaction_id: str):
+    def has_queued_lock(self, transaction_id: int):
+        """
+        Judge whether a transaction has any queued lock on this variable
+        :param transaction_id: the id of the transaction
+        """
+        return self.lock_queue.has(transaction_id, LockType.R) or self.lock_queue.has(transaction_id, LockType.W)
+
+
+    def remove_queued_locks(self, transaction_id: int):
+        """
+        Remove all queued locks of a transaction from lock queue
+        :param transaction_id: the id of the transaction
+        """
+        self.lock_queue.remove_transaction(transaction_id)
+
+
+    def share_read_lock(self, transaction_id: int):
         """
         A transaction share this lock with other existing transactions
         :param transaction_id: newly joined transaction
@@ -120,7 +226,7 @@ class VarLockManager:
         self.cur_lock.transaction_ids.add(transaction_id)
 
 
-    def release_lock_held_by_transaction(self, transaction_id: str):
+    def release_lock_held_by_transaction(self, transaction_id: int):
         """
         Release all current lock held by a transaction.
         :param transaction_id: the id of the transaction
@@ -141,3 +247,190 @@ class VarLockManager:
         else:
             if self.cur_lock.transaction_ids == transaction_id:
                 self.cur_lock = None
+
+
+############################################################
+######## Definition for Site Level Intent Lock Manager #####
+############################################################
+
+# a transaction holding more than this number of variable locks on one site will try to escalate to a site lock
+# escalation is off unless a threshold is given, e.g. 8, it changes which transactions block each other
+DEFAULT_ESCALATION_THRESHOLD = None
+
+
+@unique
+class IntentLockType(Enum):
+    IS = 0
+    IX = 1
+    S = 2
+    X = 3
+
+
+# compatibility matrix of site level locks, {requested mode: set of held modes it is compatible with}
+INTENT_COMPATIBILITY = {
+    IntentLockType.IS: {IntentLockType.IS, IntentLockType.IX, IntentLockType.S},
+    IntentLockType.IX: {IntentLockType.IS, IntentLockType.IX},
+    IntentLockType.S: {IntentLockType.IS, IntentLockType.S},
+    IntentLockType.X: set(),
+}
+
+
+class SiteLockManager:
+
+    def __init__(self, site_id: int, escalation_threshold = DEFAULT_ESCALATION_THRESHOLD):
+        """
+        Initialize SiteLockManager Object, it sits above all VarLockManagers of a site
+        Transactions take IS/IX intent locks before variable locks, and S/X locks after escalation
+        :param site_id: indicate this lock manager belong to which site
+        :param escalation_threshold: escalate once a transaction holds more variable locks than this, None disables escalation
+        """
+        self.site_id = site_id
+        self.escalation_threshold = escalation_threshold
+        self.granted = defaultdict(set) # {transaction id: set of IntentLockType held on this site}
+        self.held_variables = defaultdict(set) # {transaction id: set of variable ids locked at variable level}
+        self.waiters = {} # {transaction id: set of transaction ids it is blocked by at site level}
+        self.waiting_modes = {} # {transaction id: site lock mode it is blocked on}
+
+
+    def reset(self):
+        """
+        Reset the status of this SiteLockManager to initial status
+        """
+        self.granted = defaultdict(set)
+        self.held_variables = defaultdict(set)
+        self.waiters = {}
+        self.waiting_modes = {}
+
+
+    def conflicting_holders(self, transaction_id: int, lock_type: IntentLockType):
+        """
+        Find transactions whose site locks are incompatible with the requested lock
+        :param transaction_id: id of the requesting transaction, its own locks never conflict
+        :param lock_type: requested site lock mode
+        :return: set of transaction ids blocking this request
+        """
+        compatible = INTENT_COMPATIBILITY[lock_type]
+        return {holder for holder, modes in self.granted.items()
+                if holder != transaction_id and not modes <= compatible}
+
+
+    def acquire(self, transaction_id: int, lock_type: IntentLockType):
+        """
+        Try to obtain a site lock, covered requests (e.g. IS under S) are granted without change
+        If blocked, remember which transactions we wait for, so it shows up in wait-for graph
+        :param transaction_id: id of the requesting transaction
+        :param lock_type: requested site lock mode
+        :return: True / False means can/can't get the site lock
+        """
+        if self.covers(transaction_id, lock_type):
+            return True
+        blockers = self.conflicting_holders(transaction_id, lock_type)
+        if blockers:
+            self.waiters[transaction_id] = blockers
+            self.waiting_modes[transaction_id] = lock_type
+            return False
+        self.waiters.pop(transaction_id, None)
+        self.waiting_modes.pop(transaction_id, None)
+        self.granted[transaction_id].add(lock_type)
+        return True
+
+
+    def cancel_wait(self, transaction_id: int, lock_type: IntentLockType):
+        """
+        Stop a transaction from waiting for a site lock it does not need anymore, e.g. its read was served by another site
+        A wait for another mode is kept, it belongs to a request which still waits
+        :param transaction_id: id of the transaction
+        :param lock_type: site lock mode of the abandoned request
+        """
+        if self.waiting_modes.get(transaction_id) == lock_type:
+            self.waiters.pop(transaction_id, None)
+            self.waiting_modes.pop(transaction_id)
+
+
+    def release_unused_intent(self, transaction_id: int):
+        """
+        Release an IS lock which guards no variable lock, e.g. it was taken for a read which another site served
+        A held IS lock would block escalation of other transactions until commit
+        :param transaction_id: id of the transaction
+        :return: True means the IS lock has been released
+        """
+        if self.granted.get(transaction_id) != {IntentLockType.IS} or self.held_variables.get(transaction_id):
+            return False
+        self.release_transaction(transaction_id)
+        return True
+
+
+    def covers(self, transaction_id: int, lock_type: IntentLockType):
+        """
+        Judge whether locks already held by a transaction imply the requested site lock
+        :param transaction_id: id of the transaction
+        :param lock_type: requested site lock mode
+        :return: True means no new lock needed
+        """
+        modes = self.granted.get(transaction_id)
+        if not modes: return False
+        if IntentLockType.X in modes or lock_type in modes:
+            return True
+        if lock_type == IntentLockType.IS:
+            return bool(modes & {IntentLockType.IX, IntentLockType.S})
+        return False
+
+
+    def is_escalated(self, transaction_id: int):
+        """
+        Judge whether a transaction holds a site level S or X lock, reads then need no variable lock
+        :param transaction_id: id of the transaction
+        """
+        modes = self.granted.get(transaction_id)
+        return bool(modes) and bool(modes & {IntentLockType.S, IntentLockType.X})
+
+
+    def holds_exclusive(self, transaction_id: int):
+        """
+        Judge whether a transaction holds the site level X lock, writes then need no variable lock
+        :param transaction_id: id of the transaction
+        """
+        modes = self.granted.get(transaction_id)
+        return bool(modes) and IntentLockType.X in modes
+
+
+    def record_variable_lock(self, transaction_id: int, variable_id: int):
+        """
+        Record that a transaction holds a variable level lock on this site
+        :param transaction_id: id of the transaction
+        :param variable_id: id of the locked variable
+        :return: True means the transaction now exceeds escalation threshold
+        """
+        held = self.held_variables[transaction_id]
+        held.add(variable_id)
+        return self.escalation_threshold is not None and len(held) > self.escalation_threshold
+
+
+    def try_escalate(self, transaction_id: int, lock_type: IntentLockType):
+        """
+        Replace the intent locks of a transaction by one S or X site lock
+        Escalation never waits, it only happens when no other transaction holds a conflicting site lock
+        :param transaction_id: id of the transaction
+        :param lock_type: S or X
+        :return: set of variable ids whose variable level locks can be dropped, None if escalation did not happen
+        """
+        if self.conflicting_holders(transaction_id, lock_type):
+            return None
+        self.granted[transaction_id].add(lock_type)
+        return self.held_variables.pop(transaction_id, set())
+
+
+    def release_transaction(self, transaction_id: int):
+        """
+        Release all site locks held by a transaction, and stop it from waiting at site level
+        :param transaction_id: id of the transaction
+        """
+        self.granted.pop(transaction_id, None)
+        self.held_variables.pop(transaction_id, None)
+        self.waiters.pop(transaction_id, None)
+        self.waiting_modes.pop(transaction_id, None)
+        for waiter in list(self.waiters):
+            self.waiters[waiter].discard(transaction_id)
+            if not self.waiters[waiter]:
+                self.waiters.pop(waiter)
+                self.waiting_modes.pop(waiter, None)
@@ -0,0 +1,154 @@
+import re
+import json
+import time
+from collections import defaultdict
+
+
+# entry points wrapped on TransactionManager and on every DataManager
+TM_ENTRY_POINTS = ["solve_deadlock", "execute_operations", "read", "read_snapshot", "write", "batch_read",
+                   "batch_write", "commit", "abort", "fail", "recover", "dump", "catch_up"]
+DM_ENTRY_POINTS = ["get_wait_for_graph", "update_lock_table", "read", "read_snapshot", "check_write_lock",
+                   "queue_write_lock", "write", "commit", "abort"]
+
+
+class Profiler:
+
+    def __init__(self):
+        """
+        Initialize Profiler Object, an instrumenting profiler for TransactionManager
+        Every input line is a root frame named by its command type (R, W, end, ...), wrapped entry points are
+        nested frames. Self time of each distinct stack is accumulated, which is what flame graphs need.
+        """
+        self.stack = [] # names of currently open frames
+        self.child_time = [] # time spent in children of each open frame, in ns
+        self.self_time = defaultdict(int) # {stack tuple: self time in ns}
+        self.line_latency = defaultdict(list) # {command type: [latency of each line in ns]}
+        self.deadlock_rounds = defaultdict(lambda: [0, 0]) # {round index in a line: [number of calls, total ns]}
+        self.round_in_line = 0
+
+
+    def call(self, name: str, function, *args, **kwargs):
+        """
+        Run function inside a frame named name
+        """
+        self.stack.append(name)
+        self.child_time.append(0)
+        start = time.perf_counter_ns()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            self.self_time[tuple(self.stack)] += elapsed - self.child_time.pop()
+            self.stack.pop()
+            if self.child_time:
+                self.child_time[-1] += elapsed
+            if name == "solve_deadlock":
+                stats = self.deadlock_rounds[self.round_in_line]
+                stats[0] += 1
+                stats[1] += elapsed
+                self.round_in_line += 1
+
+
+    def wrap(self, obj, method_name: str, frame_name: str):
+        """
+        Replace a method on one object by a wrapper which records it as a frame
+        """
+        method = getattr(obj, method_name, None)
+        if method is None: return
+        def wrapper(*args, **kwargs):
+            return self.call(frame_name, method, *args, **kwargs)
+        setattr(obj, method_name, wrapper)
+
+
+    def instrument(self, tm):
+        """
+        Wrap hot entry points of a TransactionManager and all its sites
+        :param tm: the TransactionManager to profile
+        """
+        for method_name in TM_ENTRY_POINTS:
+            self.wrap(tm, method_name, method_name)
+        for site in tm.site_list:
+            for method_name in DM_ENTRY_POINTS:
+                self.wrap(site, method_name, "site." + method_name)
+
+        process_line = tm.process_line
+        def profiled_process_line(line: str):
+            words = re.findall(r"[\w']+", line)
+            command = words[0] if words else "empty"
+            self.round_in_line = 0
+            start = time.perf_counter_ns()
+            try:
+                return self.call(command, process_line, line)
+            finally:
+                self.line_latency[command].append(time.perf_counter_ns() - start)
+        tm.process_line = profiled_process_line
+
+
+    def collapsed_stacks(self):
+        """
+        :return: lines in collapsed stack format "frame;frame;frame weight", weight is self time in ns
+        """
+        return ["{} {}".format(";".join(stack), ns) for stack, ns in sorted(self.self_time.items()) if ns > 0]
+
+
+    def export_collapsed(self, path: str):
+        """
+        Write collapsed stacks, readable by flamegraph.pl / inferno / speedscope
+        """
+        with open(path, "w") as f:
+            f.write("\n".join(self.collapsed_stacks()) + "\n")
+
+
+    def export_speedscope(self, path: str, name = "RepCRec"):
+        """
+        Write a speedscope sampled profile, every distinct stack is one sample weighted by its self time
+        """
+        frame_index = {}
+        samples, weights = [], []
+        for stack, ns in sorted(self.self_time.items()):
+            if ns <= 0: continue
+            samples.append([frame_index.setdefault(frame, len(frame_index)) for frame in stack])
+            weights.append(ns)
+        profile = {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": [{"name": frame} for frame in frame_index]},
+            "profiles": [{"type": "sampled", "name": name, "unit": "nanoseconds",
+                          "startValue": 0, "endValue": sum(weights), "samples": samples, "weights": weights}],
+            "name": name,
+            "exporter": "RepCRec Profiler",
+        }
+        with open(path, "w") as f:
+            json.dump(profile, f)
+
+
+    def latency_histogram(self):
+        """
+        Per command type histogram of line latency, with power of 2 microsecond buckets
+        :return: {command type: {"count", "p50_us", "p99_us", "buckets": {"<=N us": count}}}
+        """
+        histogram = {}
+        for command, latencies in sorted(self.line_latency.items()):
+            latencies = sorted(latencies)
+            buckets = defaultdict(int)
+            for ns in latencies:
+                bound = 1
+                while bound * 1000 < ns:
+                    bound *= 2
+                buckets["<={}us".format(bound)] += 1
+            histogram[command] = {"count": len(latencies),
+                                  "p50_us": latencies[len(latencies) // 2] / 1000,
+                                  "p99_us": latencies[int(len(latencies) * 0.99)] / 1000,
+                                  "buckets": dict(buckets)}
+        return histogram
+
+
+    def report(self):
+        """
+        Human readable summary: line latency per command type, and time of each deadlock round
+        """
+        rows = ["{:<10} {:>8} {:>12} {:>12}".format("command", "count", "p50 (us)", "p99 (us)")]
+        for command, stats in self.latency_histogram().items():
+            rows.append("{:<10} {:>8} {:>12.1f} {:>12.1f}".format(command, stats["count"], stats["p50_us"], stats["p99_us"]))
+        for round_index, (calls, ns) in sorted(self.deadlock_rounds.items()):
+            rows.append("deadlock round {}: {} calls, {:.1f} ms".format(round_index, calls, ns / 1e6))
+        return "\n".join(rows)
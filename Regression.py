@@ -0,0 +1,322 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+from Transaction_Manager import TransactionManager
+from Utils import VARIABLE_IDS, TRANSACTION_IDS
+from Simulator import Simulator, NullWriter
+from Sharding import Shard
+
+
+ROOT_PATH = os.path.dirname(os.path.abspath(__file__)) # paths are resolved from here, not the current directory
+GOLDEN_PATH = os.path.join(ROOT_PATH, "golden") # golden results and timing baselines are stored here
+BASELINE_FILE = "baseline.json"
+TEST_CASE_PATH = os.path.join(ROOT_PATH, "test_cases")
+# TransactionManager options of test cases which need more than the defaults, {test case file name: kwargs}
+TEST_CASE_OPTIONS = {
+    "test22": {"escalation_threshold": 8},
+    "test26": {"escalation_threshold": 8},
+    "test27": {"escalation_threshold": 8},
+    "test29": {"catch_up_budget": 2},
+    "test30": {"admission_limit": 2, "adaptive_admission": True},
+    "test31": {"max_victim_aborts": 1, "restart_memory": 1},
+    "test32": {"aging": True},
+}
+# version_store_path of a generated trace, every run spills into a new temporary directory
+TEMP_DIRECTORY = "<temp>"
+# generated traces, {scenario name: (seed, number of lines, Simulator kwargs)}
+GENERATED_TRACES = {
+    "sim_seed1": (1, 5000, {}),
+    "sim_seed2": (2, 5000, {}),
+    # at most 4 read-write transactions at first, the limit adapts to abort and wait rates
+    "sim_admission": (5, 5000, {"admission_limit": 4, "adaptive_admission": True}),
+    # aborted transactions restart, waiting operations are retried by age and twice aborted ones are spared
+    "sim_starvation": (6, 3000, {"max_active": 16, "restart_aborted": True, "aging": True, "max_victim_aborts": 2}),
+    # recovered sites copy 2 variables per tick from peers
+    "sim_catch_up": (4, 5000, {"catch_up_budget": 2}),
+    # 2 versions per variable in memory, long read-only transactions read older versions from cold segments,
+    # written values count past int64
+    "sim_spill": (3, 5000, {"max_active": 12, "read_only_ratio": 0.5, "ops_per_transaction": 8,
+                            "first_value": 2**63 - 400, "version_store_path": TEMP_DIRECTORY, "hot_versions": 2}),
+}
+# coordinator messages fed into one shard, {scenario name: messages}
+SHARD_TRACES = {
+    # T9 begins lazily at time 8 with original begin time 2, the deadlock solved on its begin line lets
+    # deferred end(T1) commit, at time 8 and not at T9's begin time
+    "shard_lazy_begin": [("begin", 3, "T1", False, 0), ("line", 3, "R(T1,x2)"),
+                         ("begin", 4, "T2", False, 1), ("line", 4, "R(T2,x4)"),
+                         ("line", 5, "W(T1,x4,44)"), ("line", 6, "end(T1)"), ("line", 7, "W(T2,x2,22)"),
+                         ("begin", 8, "T9", False, 2), ("line", 8, "R(T9,x4)")],
+}
+# absolute noise floor on top of the ratio thresholds, tiny scenarios only take a few milliseconds
+TIME_SLACK = 0.01 # seconds
+MEMORY_SLACK = 64 # KB
+
+
+#####################################################################
+################### Recorder for Committed Results ##################
+#####################################################################
+
+class ResultRecorder:
+
+    def __init__(self):
+        """
+        Initialize ResultRecorder Object, plugged into TransactionManager.history
+        Record every read value, the outcome of every transaction and every structured dump, in the order they happen
+        """
+        self.events = []
+
+
+    def on_read(self, transaction_id: str, variable_id: str, value: int):
+        self.events.append("R {} {} {}".format(transaction_id, variable_id, value))
+
+
+    def on_write(self, transaction_id: str, variable_id: str, value: int):
+        self.events.append("W {} {} {}".format(transaction_id, variable_id, value))
+
+
+    def on_commit(self, transaction_id: str, commit_ts: int):
+        self.events.append("commit {} {}".format(transaction_id, commit_ts))
+
+
+    def on_abort(self, transaction_id: str):
+        self.events.append("abort {}".format(transaction_id))
+
+
+    def record_dumps(self, tm: TransactionManager):
+        """
+        Wrap dumpJSON of a TransactionManager, so every structured dump is recorded as an event
+        """
+        dump_json = tm.dump_json
+        def recorded_dump_json(*args, **kwargs):
+            result = dump_json(*args, **kwargs)
+            self.events.append("dumpJSON {}".format(json.dumps(result)))
+            return result
+        tm.dump_json = recorded_dump_json
+
+
+    def record_admissions(self, tm: TransactionManager):
+        """
+        Wrap admission of a TransactionManager, so every admission with its begin time
+        and every change of the admission limit is recorded as an event
+        """
+        admit_waiting_transactions = tm.admit_waiting_transactions
+        def recorded_admit_waiting_transactions():
+            waiting = [transaction_id for transaction_id, transaction in tm.transaction_table.items()
+                       if not transaction.is_admitted]
+            admit_waiting_transactions()
+            for transaction_id in waiting:
+                if tm.transaction_table[transaction_id].is_admitted:
+                    self.events.append("admit {} {}".format(TRANSACTION_IDS.names[transaction_id],
+                                                            tm.transaction_table[transaction_id].begin_time))
+        tm.admit_waiting_transactions = recorded_admit_waiting_transactions
+
+        adjust = tm.admission.adjust
+        def recorded_adjust():
+            limit = tm.admission.limit
+            adjust()
+            if tm.admission.limit != limit:
+                self.events.append("limit {}".format(tm.admission.limit))
+        tm.admission.adjust = recorded_adjust
+
+
+def final_state(tm: TransactionManager):
+    """
+    Same info as dump(), in a comparable form
+    :return: {site id: {"up": True/False, "values": {variable id: latest commit value}}}
+    """
+    return {str(site.site_id): {"up": site.is_up,
+                                "values": {VARIABLE_IDS.names[variable.variable_id]: variable.get_latest_commit_value()
+                                           for variable in site.data_table.values()}}
+            for site in tm.site_list}
+
+
+#####################################################################
+############################ Scenarios ##############################
+#####################################################################
+
+def run_test_case(file_path: str):
+    """
+    Run one input file of test cases, with its options from TEST_CASE_OPTIONS
+    :return: {"events": [...], "state": {...}}
+    """
+    tm = TransactionManager(**TEST_CASE_OPTIONS.get(os.path.basename(file_path), {}))
+    recorder = ResultRecorder()
+    tm.history = recorder
+    recorder.record_dumps(tm)
+    if tm.admission: recorder.record_admissions(tm)
+    with open(file_path, "r") as f, contextlib.redirect_stdout(NullWriter()):
+        for line in f.readlines():
+            line = line.strip()
+            if line and not line.startswith(("#","//")):
+                tm.process_line(line)
+    return {"events": recorder.events, "state": final_state(tm)}
+
+
+def run_generated_trace(seed: int, line_count: int, simulator_kwargs: dict):
+    """
+    Run a generated trace, its history is checked by Simulator as well
+    :param simulator_kwargs: passed to Simulator, a version_store_path of TEMP_DIRECTORY spills into a temporary directory
+    :return: {"summary": {...}, "state": {...}}, the summary counts spilled versions and cold reads if versions spill,
+             has catch-up stats of each site if recovered sites catch up, admission stats if admission is limited,
+             and scheduling stats with a starvation-aware scheduler
+    """
+    if simulator_kwargs.get("version_store_path") == TEMP_DIRECTORY:
+        with tempfile.TemporaryDirectory() as version_store_path:
+            return run_generated_trace(seed, line_count, dict(simulator_kwargs, version_store_path=version_store_path))
+    simulator = Simulator(seed, **simulator_kwargs)
+    checker = simulator.run(line_count)
+    summary = {"transactions": simulator.transaction_count, "committed": checker.committed,
+               "aborted": checker.aborted, "reads": checker.reads_checked, "violations": checker.violations}
+    if simulator_kwargs.get("version_store_path"):
+        segments = [variable.cold_segment for site in simulator.tm.site_list for variable in site.data_table.values()]
+        summary["cold_versions"] = sum(segment.count for segment in segments)
+        summary["wide_cold_versions"] = sum(len(segment.wide_values) for segment in segments)
+        summary["cold_reads"] = sum(segment.hits for segment in segments)
+    if simulator_kwargs.get("catch_up_budget") is not None:
+        summary["catch_up"] = simulator.tm.catch_up_stats()
+    if simulator.tm.admission:
+        summary["admission"] = simulator.tm.admission.stats()
+    if simulator.tm.scheduler:
+        summary["scheduling"] = simulator.tm.scheduler.stats()
+    return {"summary": summary, "state": final_state(simulator.tm)}
+
+
+def run_shard_trace(messages):
+    """
+    Feed coordinator messages into one Shard, like run_shard does
+    :return: {"committed": [...], "aborted": [...], "begin_times": {...}, "versions": {...}} where versions are
+             [value, commit timestamp] of every variable of site 1 written after initialization
+    """
+    shard = Shard(0, 1)
+    with contextlib.redirect_stdout(NullWriter()):
+        for message in messages:
+            shard.handle(message)
+    versions = {VARIABLE_IDS.names[variable.variable_id]: [[commit_value.value, commit_value.commit_ts]
+                                                           for commit_value in variable.commit_queue]
+                for variable in shard.tm.site_list[0].data_table.values() if len(variable.commit_queue) > 1}
+    return {"committed": sorted(shard.committed), "aborted": sorted(shard.aborted),
+            "begin_times": {TRANSACTION_IDS.names[transaction_id]: transaction.begin_time
+                            for transaction_id, transaction in shard.tm.transaction_table.items()},
+            "versions": versions}
+
+
+def all_scenarios():
+    """
+    :return: {scenario name: function without para which runs the scenario}
+    """
+    scenarios = {}
+    for file in sorted(os.listdir(TEST_CASE_PATH), key=lambda name: (len(name), name)):
+        if not file.startswith("test"): continue
+        scenarios[file] = lambda path=os.path.join(TEST_CASE_PATH, file): run_test_case(path)
+    for name, (seed, line_count, simulator_kwargs) in GENERATED_TRACES.items():
+        scenarios[name] = lambda seed=seed, line_count=line_count, simulator_kwargs=simulator_kwargs: \
+            run_generated_trace(seed, line_count, simulator_kwargs)
+    for name, messages in SHARD_TRACES.items():
+        scenarios[name] = lambda messages=messages: run_shard_trace(messages)
+    return scenarios
+
+
+def measure(scenario, repeat: int):
+    """
+    Run a scenario several times
+    :return: (result, best wall time in seconds, peak traced memory in KB)
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = scenario()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    # memory is traced in a separate run, tracing slows down the timed runs
+    tracemalloc.start()
+    scenario()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak / 1024
+
+
+#####################################################################
+########################## Regression Gate ##########################
+#####################################################################
+
+def golden_file(name: str):
+    return os.path.join(GOLDEN_PATH, name + ".json")
+
+
+def read_json(path: str):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_json(path: str, content):
+    with open(path, "w") as f:
+        json.dump(content, f, indent=1, sort_keys=True)
+        f.write("\n")
+
+
+def run_gate(update: bool, max_slowdown: float, max_memory_growth: float, repeat: int, only = None):
+    """
+    Compare every scenario with its golden result and timing baseline
+    :param update: write current results and timings as new golden files instead of comparing
+    :param max_slowdown: fail if best time exceeds baseline by more than this ratio, e.g. 0.5 means 50% slower
+    :param max_memory_growth: fail if peak memory exceeds baseline by more than this ratio
+    :param repeat: number of timed runs per scenario, the best one counts
+    :param only: names of scenarios to run, None means all
+    :return: list of failure messages
+    """
+    os.makedirs(GOLDEN_PATH, exist_ok=True)
+    baseline_path = os.path.join(GOLDEN_PATH, BASELINE_FILE)
+    baseline = read_json(baseline_path) if os.path.exists(baseline_path) else {}
+    failures = []
+
+    for name, scenario in all_scenarios().items():
+        if only and name not in only: continue
+        result, seconds, memory_kb = measure(scenario, repeat)
+        print("{:<12} {:>9.4f}s {:>10.1f}KB".format(name, seconds, memory_kb))
+
+        if update:
+            write_json(golden_file(name), result)
+            baseline[name] = {"seconds": round(seconds, 6), "memory_kb": round(memory_kb, 1)}
+            continue
+
+        if not os.path.exists(golden_file(name)):
+            failures.append("{}: no golden file, run with --update first".format(name))
+            continue
+        # round trip through json, so tuples / int keys compare like the stored file
+        if json.loads(json.dumps(result)) != read_json(golden_file(name)):
+            failures.append("{}: result differs from golden file {}".format(name, golden_file(name)))
+        if name not in baseline:
+            failures.append("{}: no timing baseline".format(name))
+            continue
+        expected = baseline[name]
+        if seconds > expected["seconds"] * (1 + max_slowdown) + TIME_SLACK:
+            failures.append("{}: {:.4f}s, baseline {:.4f}s".format(name, seconds, expected["seconds"]))
+        if memory_kb > expected["memory_kb"] * (1 + max_memory_growth) + MEMORY_SLACK:
+            failures.append("{}: {:.1f}KB, baseline {:.1f}KB".format(name, memory_kb, expected["memory_kb"]))
+
+    if update:
+        write_json(baseline_path, baseline)
+    return failures
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Compare results, latency and memory against golden files")
+    parser.add_argument("--update", action="store_true", help="store current results and timings as golden files")
+    parser.add_argument("--max-slowdown", type=float, default=0.5, help="allowed time increase ratio, default 0.5")
+    parser.add_argument("--max-memory-growth", type=float, default=0.2, help="allowed peak memory increase ratio, default 0.2")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per scenario, best one counts")
+    parser.add_argument("scenarios", nargs="*", help="names of scenarios to run, e.g. test1 sim_seed1, default all")
+    args = parser.parse_args()
+
+    failures = run_gate(args.update, args.max_slowdown, args.max_memory_growth, args.repeat, set(args.scenarios))
+    for failure in failures:
+        print("FAIL: " + failure)
+    if not args.update:
+        print("regression gate {}".format("failed" if failures else "passed"))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,514 @@
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import contextlib
+import multiprocessing
+from collections import defaultdict
+from Transaction_Manager import TransactionManager
+from Utils import InvalidCommandError, VARIABLE_IDS, TRANSACTION_IDS, named_graph
+
+
+DEFAULT_DEADLOCK_INTERVAL = 16 # lines between two global deadlock detections
+DEFAULT_BATCH_SIZE = 64 # messages buffered per shard before they are sent
+
+
+def shard_of(variable_id: str, shard_count: int):
+    """
+    Variables are partitioned by index, xi belongs to shard i % shard_count
+    """
+    return int(variable_id[1:]) % shard_count
+
+
+#####################################################################
+######################## Shard, one per process #####################
+#####################################################################
+
+class Shard:
+
+    def __init__(self, shard_id: int, shard_count: int, **tm_kwargs):
+        """
+        Initialize Shard Object, a TransactionManager which only serves the variables of its shard
+        Every shard has all 10 sites, site i of a shard holds the copies of its variables which live on site i
+        Shard-local deadlocks are still solved by its TransactionManager, cross-shard ones by the coordinator
+        :param shard_id: id of this shard, from 0
+        :param shard_count: number of shards
+        :param tm_kwargs: options of TransactionManager
+        """
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        # a transaction begins on a shard at its first operation there, but keeps its original begin time,
+        # so the epoch at the end of its begin tick, the key of the snapshot cache, is not the one of its snapshot
+        tm_kwargs["snapshot_cache_size"] = 0
+        # generated input does not know whether an operation blocks, so it may end a transaction which still waits
+        tm_kwargs["defer_blocked_end"] = True
+        self.tm = TransactionManager(**tm_kwargs)
+        self.tm.history = self
+        self.committed = set() # ids of transactions committed on this shard
+        self.aborted = set() # ids of transactions aborted on this shard
+        self.new_finished = [] # (transaction id, committed) the coordinator has not been told about yet
+        self.rejected_lines = 0
+        self.clock = 0 # latest coordinator time seen, commits on this shard never go back in time
+
+
+    def on_read(self, transaction_id: str, variable_id: str, value: int):
+        pass
+
+
+    def on_write(self, transaction_id: str, variable_id: str, value: int):
+        pass
+
+
+    def on_commit(self, transaction_id: str, commit_ts: int):
+        self.committed.add(transaction_id)
+        self.new_finished.append((transaction_id, True))
+
+
+    def on_abort(self, transaction_id: str):
+        self.aborted.add(transaction_id)
+        self.new_finished.append((transaction_id, False))
+
+
+    def advance_clock(self, ts: int):
+        """
+        Set time of the TransactionManager to a coordinator time, it never moves backwards
+        """
+        self.clock = max(self.clock, ts)
+        self.tm.ts = self.clock
+
+
+    def process_line(self, line: str):
+        """
+        Process a line on the TransactionManager, a line it rejects is counted instead of raised
+        """
+        try:
+            self.tm.process_line(line)
+        except InvalidCommandError as e:
+            # e.g. an operation of a transaction this shard has aborted for a deadlock
+            self.rejected_lines += 1
+            print("rejected {}: {}".format(line, e))
+
+
+    def handle(self, message: tuple):
+        """
+        Handle one message from the coordinator
+        :param message: ("line", ts, line), ("begin", ts, T, is read-only, begin time), ("prepare", ts, T),
+                        ("decide", ts, T, commit), ("abort", ts, T), ("graph",), ("state",) or ("stats",)
+        :return: reply for prepare ("yes", "no" or "wait") / graph / state / stats, None for others
+        Messages carry transaction and variable names, dense ids of a TransactionManager differ between processes
+        """
+        kind = message[0]
+        if kind == "line":
+            self.advance_clock(message[1])
+            self.process_line(message[2])
+        elif kind == "begin":
+            # begin at current time, the line may end deferred transactions, then take the original begin time,
+            # so victim choice and snapshot reads are the same as on a single TransactionManager
+            _, ts, transaction_id, is_read_only, begin_time = message
+            self.advance_clock(ts)
+            self.process_line("{}({})".format("beginRO" if is_read_only else "begin", transaction_id))
+            transaction = self.tm.transaction_table.get(TRANSACTION_IDS.index.get(transaction_id))
+            if transaction:
+                transaction.begin_time = begin_time
+                if not transaction.restarts: transaction.first_begin_time = begin_time
+        elif kind == "prepare":
+            # vote no if this part of the transaction is gone or accessed a failed site, wait if it still has operations
+            transaction = self.tm.transaction_table.get(TRANSACTION_IDS.index.get(message[2]))
+            if transaction is None or transaction.should_abort: return "no"
+            return "wait" if self.tm.has_waiting_operation(transaction.transaction_id) else "yes"
+        elif kind in ("decide", "abort"):
+            self.advance_clock(message[1])
+            transaction_id = TRANSACTION_IDS.index.get(message[2])
+            if transaction_id in self.tm.transaction_table:
+                if kind == "decide" and message[3]:
+                    self.tm.commit(transaction_id, self.tm.ts)
+                else:
+                    self.tm.abort(transaction_id)
+                self.tm.execute_operations()
+        elif kind == "graph":
+            new_finished, self.new_finished = self.new_finished, []
+            return dict(named_graph(self.tm.collect_wait_for_graph())), new_finished
+        elif kind == "state":
+            return {site.site_id: {VARIABLE_IDS.names[variable.variable_id]: variable.get_latest_commit_value()
+                                   for variable in site.data_table.values()
+                                   if shard_of(VARIABLE_IDS.names[variable.variable_id], self.shard_count) == self.shard_id}
+                    for site in self.tm.site_list}
+        elif kind == "stats":
+            return {"committed": self.committed, "aborted": self.aborted, "rejected": self.rejected_lines}
+        return None
+
+
+def run_shard(conn, shard_id: int, shard_count: int, log_path, tm_kwargs: dict):
+    """
+    Process entry of a shard, handle batches of messages until ("stop",)
+    Replies of a batch are sent back together, output goes to log_path or is discarded
+    """
+    shard = Shard(shard_id, shard_count, **tm_kwargs)
+    with open(log_path or os.devnull, "w") as output, contextlib.redirect_stdout(output):
+        while True:
+            messages = conn.recv()
+            if messages[-1] == ("stop",): break
+            replies = [reply for reply in map(shard.handle, messages) if reply is not None]
+            if replies: conn.send(replies)
+    conn.close()
+
+
+#####################################################################
+################# Coordinator, in the calling process ###############
+#####################################################################
+
+class ShardedTransaction:
+
+    def __init__(self, transaction_id: str, begin_time: int, is_read_only: bool):
+        self.transaction_id = transaction_id
+        self.begin_time = begin_time
+        self.is_read_only = is_read_only
+        self.shards = set() # ids of shards this transaction has begun on
+
+
+class ShardedTransactionManager:
+
+    def __init__(self, shard_count: int, deadlock_interval = DEFAULT_DEADLOCK_INTERVAL,
+                 batch_size = DEFAULT_BATCH_SIZE, log_dir = None, **tm_kwargs):
+        """
+        Initialize ShardedTransactionManager, start one process per shard
+        Single-shard transactions end on their shard, cross-shard read-write transactions use two-phase commit
+        :param shard_count: number of shard processes
+        :param deadlock_interval: lines between two global deadlock detections over the union of shard graphs
+        :param batch_size: messages buffered per shard before sending, replies force an earlier send
+        :param log_dir: directory for output of each shard, None discards it
+        :param tm_kwargs: options of the TransactionManager of every shard
+        """
+        self.shard_count = shard_count
+        self.deadlock_interval = deadlock_interval
+        self.batch_size = batch_size
+        self.ts = 0
+        self.transaction_table = {} # {transaction id: ShardedTransaction}
+        # transactions whose end was sent to their shard, a shard may defer it, so they can still be deadlock victims
+        self.ending_table = {}
+        self.outbox = [[] for _ in range(shard_count)] # messages not sent yet, per shard
+        self.cross_shard_commits = 0
+        self.cross_shard_aborts = 0
+        self.deadlock_aborts = 0
+        self.deferred_ends = [] # cross-shard transactions whose commit waits for their operations
+
+        if log_dir: os.makedirs(log_dir, exist_ok=True)
+        self.connections = []
+        self.processes = []
+        for shard_id in range(shard_count):
+            conn, child_conn = multiprocessing.Pipe()
+            log_path = os.path.join(log_dir, "shard_{}.log".format(shard_id)) if log_dir else None
+            process = multiprocessing.Process(target=run_shard, args=(child_conn, shard_id, shard_count, log_path, tm_kwargs))
+            process.start()
+            self.connections.append(conn)
+            self.processes.append(process)
+
+
+    def send(self, shard_id: int, message: tuple):
+        self.outbox[shard_id].append(message)
+        if len(self.outbox[shard_id]) >= self.batch_size:
+            self.flush(shard_id)
+
+
+    def flush(self, shard_id: int):
+        if self.outbox[shard_id]:
+            self.connections[shard_id].send(self.outbox[shard_id])
+            self.outbox[shard_id] = []
+
+
+    def request(self, shard_ids, message: tuple):
+        """
+        Send a message which expects a reply to several shards, they work on it in parallel
+        :return: list of replies, in order of shard_ids
+        """
+        for shard_id in shard_ids:
+            self.outbox[shard_id].append(message)
+            self.flush(shard_id)
+        return [self.connections[shard_id].recv()[-1] for shard_id in shard_ids]
+
+
+    def process_line(self, line: str):
+        """
+        Parse a line and route it to the shards of the variables it accesses
+        :param line: a line from input file
+        """
+        paras = re.findall(r"[\w']+", line)
+        command = paras.pop(0)
+
+        if command in ("begin", "beginRO"):
+            if paras[0] in self.transaction_table:
+                raise InvalidCommandError("{} already begins".format(paras[0]))
+            self.transaction_table[paras[0]] = ShardedTransaction(paras[0], self.ts, command == "beginRO")
+        elif command in ("R", "W"):
+            self.route(paras[0], shard_of(paras[1], self.shard_count), line)
+        elif command == "MR":
+            shard_variables = defaultdict(list)
+            for variable_id in paras[1:]:
+                shard_variables[shard_of(variable_id, self.shard_count)].append(variable_id)
+            for shard_id, variable_ids in shard_variables.items():
+                self.route(paras[0], shard_id, "MR({})".format(",".join([paras[0]] + variable_ids)))
+        elif command == "MW":
+            if len(paras) < 3 or len(paras) % 2 == 0:
+                raise InvalidCommandError("MW expects a transaction followed by variable, value pairs: {}".format(paras))
+            shard_items = defaultdict(list)
+            for i in range(1, len(paras), 2):
+                shard_items[shard_of(paras[i], self.shard_count)] += [paras[i], paras[i+1]]
+            for shard_id, items in shard_items.items():
+                self.route(paras[0], shard_id, "MW({})".format(",".join([paras[0]] + items)))
+        elif command == "end":
+            self.end(paras[0])
+        elif command in ("fail", "recover", "dump", "dumpJSON"):
+            # a site spans all shards, so does its failure
+            for shard_id in range(self.shard_count):
+                self.send(shard_id, ("line", self.ts, line))
+        else:
+            raise InvalidCommandError("Unknown Instruction: " + command)
+
+        self.ts += 1
+        if self.ts % self.deadlock_interval == 0:
+            self.solve_deadlock()
+
+
+    def route(self, transaction_id: str, shard_id: int, line: str):
+        """
+        Send an operation to a shard, begin the transaction there first if this is its first operation on it
+        """
+        transaction: ShardedTransaction = self.transaction_table.get(transaction_id)
+        if not transaction:
+            raise InvalidCommandError("{} doesn't exist".format(transaction_id))
+        if shard_id not in transaction.shards:
+            transaction.shards.add(shard_id)
+            self.send(shard_id, ("begin", self.ts, transaction_id, transaction.is_read_only, transaction.begin_time))
+        self.send(shard_id, ("line", self.ts, line))
+
+
+    def end(self, transaction_id: str):
+        """
+        End a transaction, on its only shard, or by two-phase commit over all shards it accessed
+        :param transaction_id: id of this transaction
+        """
+        transaction: ShardedTransaction = self.transaction_table.get(transaction_id)
+        if not transaction:
+            raise InvalidCommandError("{} doesn't exist".format(transaction_id))
+        shard_ids = sorted(transaction.shards)
+        if len(shard_ids) == 1:
+            self.send(shard_ids[0], ("line", self.ts, "end({})".format(transaction_id)))
+            self.ending_table[transaction_id] = self.transaction_table.pop(transaction_id)
+            return
+        if transaction.is_read_only:
+            # read-only transactions never abort, no vote needed
+            for shard_id in shard_ids:
+                self.send(shard_id, ("decide", self.ts, transaction_id, True))
+            self.transaction_table.pop(transaction_id)
+            return
+        # a participant which waits in a deadlock would never vote, so first solve deadlocks
+        self.solve_deadlock()
+        if transaction_id not in self.transaction_table: return # aborted as deadlock victim
+        self.ending_table[transaction_id] = self.transaction_table.pop(transaction_id)
+        if not self.two_phase_commit(transaction):
+            self.deferred_ends.append(transaction)
+
+
+    def two_phase_commit(self, transaction: ShardedTransaction):
+        """
+        Ask all shards of a transaction to prepare, commit if all vote yes, abort if any votes no
+        :return: False if some shard still has waiting operations of it, the end has to be tried again later
+        """
+        votes = self.request(sorted(transaction.shards), ("prepare", self.ts, transaction.transaction_id))
+        if "no" not in votes and "wait" in votes: return False
+        commit = "no" not in votes
+        self.ending_table.pop(transaction.transaction_id)
+        for shard_id in transaction.shards:
+            self.send(shard_id, ("decide", self.ts, transaction.transaction_id, commit))
+        if commit:
+            self.cross_shard_commits += 1
+        else:
+            self.cross_shard_aborts += 1
+        return True
+
+
+    def abort(self, transaction_id: str):
+        """
+        Abort a transaction on all shards it accessed
+        """
+        transaction: ShardedTransaction = self.transaction_table.pop(transaction_id, None) or \
+                                           self.ending_table.pop(transaction_id, None)
+        if not transaction: return
+        for shard_id in transaction.shards:
+            self.send(shard_id, ("abort", self.ts, transaction_id))
+
+
+    def solve_deadlock(self):
+        """
+        Collect waits-for graphs of all shards, abort youngest transaction of each cycle in their union
+        Transactions a shard aborted by itself are aborted on their other shards as well
+        Deferred cross-shard ends are tried again afterwards
+        """
+        global_graph = defaultdict(set)
+        for shard_graph, new_finished in self.request(range(self.shard_count), ("graph",)):
+            for node, wait_set in shard_graph.items():
+                global_graph[node] |= wait_set
+            for transaction_id, committed in new_finished:
+                if committed:
+                    self.ending_table.pop(transaction_id, None)
+                else:
+                    self.abort(transaction_id)
+
+        # check whether we can start from node and return to same node
+        def dfs(node, target):
+            if len(visited)!= 0 and node == target: return True
+            for nei in global_graph[node]:
+                if nei not in visited:
+                    visited.add(nei)
+                    if dfs(nei, target): return True
+            return False
+
+        while True:
+            youngest_transaction = None
+            for start_node in list(global_graph.keys()):
+                visited = set()
+                transaction = self.transaction_table.get(start_node) or self.ending_table.get(start_node)
+                if transaction and dfs(start_node, start_node):
+                    if not youngest_transaction or transaction.begin_time > youngest_transaction.begin_time:
+                        youngest_transaction = transaction
+            if not youngest_transaction: break
+            self.abort(youngest_transaction.transaction_id)
+            self.deadlock_aborts += 1
+            global_graph.pop(youngest_transaction.transaction_id)
+            for wait_set in global_graph.values():
+                wait_set.discard(youngest_transaction.transaction_id)
+
+        self.deferred_ends = [transaction for transaction in self.deferred_ends
+                              if transaction.transaction_id in self.ending_table and not self.two_phase_commit(transaction)]
+
+
+    def close(self):
+        """
+        Finish all sent work, collect final state and stats, stop shard processes
+        :return: (final state {site id: {variable id: value}}, stats)
+        """
+        self.solve_deadlock()
+        states = self.request(range(self.shard_count), ("state",))
+        shard_stats = self.request(range(self.shard_count), ("stats",))
+        for shard_id in range(self.shard_count):
+            self.connections[shard_id].send([("stop",)])
+        for process in self.processes:
+            process.join()
+
+        state = defaultdict(dict)
+        for shard_state in states:
+            for site_id, values in shard_state.items():
+                state[site_id].update(values)
+        committed = set().union(*(stats["committed"] for stats in shard_stats))
+        aborted = set().union(*(stats["aborted"] for stats in shard_stats))
+        stats = {"committed": len(committed - aborted), "aborted": len(aborted),
+                 "cross_shard_commits": self.cross_shard_commits, "cross_shard_aborts": self.cross_shard_aborts,
+                 "global_deadlock_aborts": self.deadlock_aborts, "unfinished_ends": len(self.deferred_ends),
+                 "rejected_lines": sum(stats["rejected"] for stats in shard_stats)}
+        return dict(state), stats
+
+
+#####################################################################
+####################### Partitionable Workload ######################
+#####################################################################
+
+def generate_workload(seed: int, line_count: int, partitions = 4, max_active = 16, ops_per_transaction = 4,
+                      write_ratio = 0.5, cross_partition_ratio = 0.0):
+    """
+    Generate input lines, each transaction only accesses variables xi with the same i % partitions,
+    except a cross_partition_ratio share of transactions which access any variable
+    :return: list of lines
+    """
+    rng = random.Random(seed)
+    lines = []
+    active = {} # {transaction id: [variable indexes it may access, operations left]}
+    next_id = 1
+    while len(lines) < line_count:
+        if len(active) < max_active:
+            transaction_id = "T{}".format(next_id)
+            next_id += 1
+            if rng.random() < cross_partition_ratio:
+                indexes = list(range(1, 21))
+            else:
+                partition = rng.randrange(partitions)
+                indexes = [i for i in range(1, 21) if i % partitions == partition]
+            active[transaction_id] = [indexes, ops_per_transaction]
+            lines.append("begin({})".format(transaction_id))
+            continue
+        transaction_id = rng.choice(list(active))
+        indexes, ops_left = active[transaction_id]
+        if ops_left == 0:
+            del active[transaction_id]
+            lines.append("end({})".format(transaction_id))
+            continue
+        active[transaction_id][1] -= 1
+        variable_id = "x{}".format(rng.choice(indexes))
+        if rng.random() < write_ratio:
+            lines.append("W({},{},{})".format(transaction_id, variable_id, rng.randrange(100000)))
+        else:
+            lines.append("R({},{})".format(transaction_id, variable_id))
+    return lines
+
+
+def run_single(lines):
+    """
+    Run lines on one in-process TransactionManager, the same way a shard does
+    :return: final state {site id: {variable id: value}}
+    """
+    tm = TransactionManager(defer_blocked_end=True)
+    with open(os.devnull, "w") as output, contextlib.redirect_stdout(output):
+        for ts, line in enumerate(lines):
+            tm.ts = ts
+            try:
+                tm.process_line(line)
+            except InvalidCommandError:
+                pass
+    return {site.site_id: {VARIABLE_IDS.names[variable.variable_id]: variable.get_latest_commit_value()
+                           for variable in site.data_table.values()}
+            for site in tm.site_list}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Run input on transaction manager shards in separate processes")
+    parser.add_argument("input_file", nargs="?", help="input file, default a generated partitionable workload")
+    parser.add_argument("--shards", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--lines", type=int, default=100000, help="number of generated lines")
+    parser.add_argument("--partitions", type=int, default=4, help="variable partitions of generated transactions")
+    parser.add_argument("--cross-partition-ratio", type=float, default=0.0)
+    parser.add_argument("--deadlock-interval", type=int, default=DEFAULT_DEADLOCK_INTERVAL)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--log-dir", default=None, help="directory for output of each shard")
+    parser.add_argument("--check", action="store_true",
+                        help="compare final state with a single TransactionManager, only for partitionable input")
+    args = parser.parse_args()
+
+    if args.input_file:
+        with open(args.input_file, "r") as f:
+            lines = [line.strip() for line in f.readlines()]
+        lines = [line for line in lines if line and not line.startswith(("#","//"))]
+    else:
+        lines = generate_workload(args.seed, args.lines, args.partitions,
+                                  cross_partition_ratio=args.cross_partition_ratio)
+
+    start = time.perf_counter()
+    manager = ShardedTransactionManager(args.shards, args.deadlock_interval, args.batch_size, args.log_dir)
+    for line in lines:
+        try:
+            manager.process_line(line)
+        except InvalidCommandError:
+            pass
+    state, stats = manager.close()
+    elapsed = time.perf_counter() - start
+    print("shards: {}, lines: {}, {:.2f}s, {:.0f} lines/s".format(args.shards, len(lines), elapsed, len(lines) / elapsed))
+    print(stats)
+
+    if args.check:
+        expected = run_single(lines)
+        if state != expected:
+            print("final state differs from a single TransactionManager")
+            sys.exit(1)
+        print("final state equals a single TransactionManager")
@@ -0,0 +1,371 @@
+import sys
+import time
+import random
+import argparse
+import contextlib
+from bisect import bisect_right
+from collections import defaultdict, deque
+from Transaction_Manager import TransactionManager
+from Utils import InvalidCommandError, DEFAULT_RESTART_MEMORY, VARIABLE_IDS, TRANSACTION_IDS
+
+
+#####################################################################
+############### History Checker for Committed History ###############
+#####################################################################
+
+class HistoryChecker:
+
+    def __init__(self, initial_values: dict):
+        """
+        Initialize HistoryChecker Object
+        Record committed history reported by TransactionManager, and check it incrementally:
+        (1) read-write transactions must be conflict-serializable, checked on a multiversion precedence graph
+        (2) read-only transactions must read the latest version committed before they begin
+        Written values must be unique per variable, so a read value identifies the version it read
+        :param initial_values: {variable id: initial value}, versions committed at time 0 by nobody
+        """
+        self.writers = {var: [None] for var in initial_values} # {variable id: writer of each version, in commit order}
+        self.commit_ts = {var: [0] for var in initial_values} # {variable id: commit timestamp of each version}
+        self.values = {var: [value] for var, value in initial_values.items()} # {variable id: value of each version}
+        self.value_index = {var: {value: 0} for var, value in initial_values.items()} # {variable id: {value: version}}
+        self.readers = defaultdict(list) # {(variable id, version): committed transactions which read this version}
+
+        self.read_only = {} # {transaction id: begin timestamp} of active read-only transactions
+        self.pending_reads = defaultdict(list) # {transaction id: [(variable id, version)]} until commit
+        self.pending_writes = defaultdict(dict) # {transaction id: {variable id: last written value}} until commit
+
+        # precedence graph over committed transactions, with a topological order maintained incrementally
+        self.successors = defaultdict(set)
+        self.predecessors = defaultdict(set)
+        self.order = {} # {transaction id: position in topological order}
+        self.next_position = 0
+
+        self.violations = []
+        self.committed = 0
+        self.aborted = 0
+        self.reads_checked = 0
+
+
+    def on_begin(self, transaction_id: str, begin_ts: int, is_read_only: bool):
+        """
+        Record a transaction begin, only read-only transactions need their begin timestamp
+        """
+        if is_read_only:
+            self.read_only[transaction_id] = begin_ts
+
+
+    def on_read(self, transaction_id: str, variable_id: str, value: int):
+        """
+        Record a successful read, snapshot reads are checked immediately
+        """
+        self.reads_checked += 1
+        if transaction_id in self.read_only:
+            begin_ts = self.read_only[transaction_id]
+            expected = self.values[variable_id][bisect_right(self.commit_ts[variable_id], begin_ts) - 1]
+            if value != expected:
+                self.violations.append("{} (read-only, begin at {}) read {}={}, expected {}".
+                                       format(transaction_id, begin_ts, variable_id, value, expected))
+            return
+        # read own uncommitted write
+        if self.pending_writes[transaction_id].get(variable_id) == value:
+            return
+        version = self.value_index[variable_id].get(value)
+        if version is None:
+            self.violations.append("{} read {}={}, which is not a committed value".format(transaction_id, variable_id, value))
+            return
+        self.pending_reads[transaction_id].append((variable_id, version))
+
+
+    def on_write(self, transaction_id: str, variable_id: str, value: int):
+        """
+        Record a successful write, it becomes a version only when transaction commits
+        """
+        self.pending_writes[transaction_id][variable_id] = value
+
+
+    def on_abort(self, transaction_id: str):
+        """
+        Forget everything an aborted transaction did
+        """
+        self.aborted += 1
+        self.read_only.pop(transaction_id, None)
+        self.pending_reads.pop(transaction_id, None)
+        self.pending_writes.pop(transaction_id, None)
+
+
+    def on_commit(self, transaction_id: str, commit_ts: int):
+        """
+        Install versions written by the transaction, and add its edges to precedence graph:
+        wr: writer of a read version -> reader, ww: writer of previous version -> writer,
+        rw: reader of a version -> writer of next version
+        """
+        self.committed += 1
+        if self.read_only.pop(transaction_id, None) is not None:
+            return
+        self.order[transaction_id] = self.next_position
+        self.next_position += 1
+
+        for variable_id, version in self.pending_reads.pop(transaction_id, ()):
+            self.add_edge(self.writers[variable_id][version], transaction_id)
+            if version + 1 < len(self.writers[variable_id]):
+                self.add_edge(transaction_id, self.writers[variable_id][version + 1])
+            self.readers[(variable_id, version)].append(transaction_id)
+
+        for variable_id, value in self.pending_writes.pop(transaction_id, {}).items():
+            previous = len(self.writers[variable_id]) - 1
+            self.add_edge(self.writers[variable_id][previous], transaction_id)
+            for reader in self.readers[(variable_id, previous)]:
+                self.add_edge(reader, transaction_id)
+            if value in self.value_index[variable_id]:
+                self.violations.append("{} wrote duplicate value {}={}, history is ambiguous".format(transaction_id, variable_id, value))
+            self.writers[variable_id].append(transaction_id)
+            self.commit_ts[variable_id].append(commit_ts)
+            self.values[variable_id].append(value)
+            self.value_index[variable_id][value] = previous + 1
+
+
+    def add_edge(self, source: str, target: str):
+        """
+        Add an edge into precedence graph, keeping topological order (Pearce-Kelly)
+        An edge which agrees with current order costs O(1). Otherwise only the region between
+        the 2 positions is searched, a cycle there is a serializability violation.
+        """
+        if source is None or source == target or target in self.successors[source]:
+            return
+        lower, upper = self.order[target], self.order[source]
+        # source already before target in topological order
+        if upper < lower:
+            self.successors[source].add(target)
+            self.predecessors[target].add(source)
+            return
+
+        # nodes reachable from target within the affected region
+        forward, stack = {target}, [target]
+        while stack:
+            node = stack.pop()
+            for nei in self.successors[node]:
+                if nei == source:
+                    self.violations.append("cycle in precedence graph through {} -> {}".format(source, target))
+                    return
+                if nei not in forward and self.order[nei] < upper:
+                    forward.add(nei)
+                    stack.append(nei)
+        # nodes reaching source within the affected region
+        backward, stack = {source}, [source]
+        while stack:
+            node = stack.pop()
+            for nei in self.predecessors[node]:
+                if nei not in backward and self.order[nei] > lower:
+                    backward.add(nei)
+                    stack.append(nei)
+
+        # move backward set before forward set, reusing their positions
+        nodes = sorted(backward, key=self.order.get) + sorted(forward, key=self.order.get)
+        positions = sorted(self.order[node] for node in nodes)
+        for node, position in zip(nodes, positions):
+            self.order[node] = position
+        self.successors[source].add(target)
+        self.predecessors[target].add(source)
+
+
+#####################################################################
+######################## Workload Simulator #########################
+#####################################################################
+
+class NullWriter:
+    """Swallow everything TransactionManager prints during simulation"""
+
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class Simulator:
+
+    def __init__(self, seed: int, max_active = 8, read_only_ratio = 0.2, write_ratio = 0.5, ops_per_transaction = 4,
+                 fail_rate = 0.01, recover_rate = 0.05, restart_aborted = False, first_value = 1000, **tm_kwargs):
+        """
+        Initialize a deterministic workload simulator, same seed and paras always produce same input lines
+        Every transaction issues one operation at a time, and only ends when it has no waiting operation
+        :param seed: seed of random generator
+        :param max_active: max number of active transactions
+        :param read_only_ratio: fraction of transactions which are read-only
+        :param write_ratio: fraction of operations of read-write transactions which are writes
+        :param ops_per_transaction: max number of operations a transaction issues before end
+        :param fail_rate: probability that a line fails a random up site
+        :param recover_rate: probability that a line recovers a random down site
+        :param restart_aborted: like a client retry, begin an aborted read-write transaction again with the same id
+        :param first_value: written values count up from here, must be larger than all initial values, e.g. 2**63 - 100
+                            lets later values outgrow int64
+        :param tm_kwargs: passed to TransactionManager, e.g. catch_up_budget
+        """
+        self.rng = random.Random(seed)
+        self.max_active = max_active
+        self.read_only_ratio = read_only_ratio
+        self.write_ratio = write_ratio
+        self.ops_per_transaction = ops_per_transaction
+        self.fail_rate = fail_rate
+        self.recover_rate = recover_rate
+        self.restart_aborted = restart_aborted
+
+        self.tm = TransactionManager(**tm_kwargs)
+        initial_values = {}
+        for site in self.tm.site_list:
+            for variable in site.data_table.values():
+                initial_values[VARIABLE_IDS.names[variable.variable_id]] = variable.get_latest_commit_value()
+        self.variables = sorted(initial_values, key=lambda var: int(var[1:]))
+        self.checker = HistoryChecker(initial_values)
+        self.tm.history = self.checker
+
+        self.active = {} # {transaction id: number of operations left before end}
+        self.restart_queue = deque() # ids of aborted read-write transactions which begin again
+        self.transaction_count = 0
+        self.next_value = first_value # written values are unique, larger than all initial values
+        self.lines = 0
+        self.rejected_lines = 0 # lines about a transaction which deadlock detection aborted right before them
+
+
+    def next_line(self):
+        """
+        Generate next input line according to current state of TransactionManager
+        """
+        # deadlock victims disappear from transaction table, which is keyed by dense ids
+        live = TRANSACTION_IDS.names_of(self.tm.transaction_table)
+        if self.restart_aborted:
+            self.restart_queue.extend(tid for tid in self.active if tid not in live)
+        self.active = {tid: left for tid, left in self.active.items() if tid in live}
+        waiting = TRANSACTION_IDS.names_of(operation.transaction_id for operation in self.tm.operation_list)
+        idle = [tid for tid in self.active if tid not in waiting]
+        up_sites = [site.site_id for site in self.tm.site_list if site.is_up]
+        down_sites = [site.site_id for site in self.tm.site_list if not site.is_up]
+
+        if len(up_sites) > 1 and self.rng.random() < self.fail_rate:
+            return "fail({})".format(self.rng.choice(up_sites))
+        if down_sites and self.rng.random() < self.recover_rate:
+            return "recover({})".format(self.rng.choice(down_sites))
+        if len(self.active) < self.max_active and (not idle or self.rng.random() < 0.3):
+            return self.begin_line()
+        if idle:
+            return self.operation_line(self.rng.choice(idle))
+
+        # everything is blocked, recovery, giving up a read-only transaction or a new transaction can make progress
+        if down_sites:
+            return "recover({})".format(self.rng.choice(down_sites))
+        read_only = [tid for tid in self.active if self.tm.transaction_table[TRANSACTION_IDS.index[tid]].is_read_only]
+        if read_only:
+            self.active.pop(read_only[0])
+            return "end({})".format(read_only[0])
+        # readers of replicated variables on a recovered site wait for a committed write, let a new transaction do it
+        return self.begin_line()
+
+
+    def begin_line(self):
+        """
+        Begin a new transaction, or restart an aborted one
+        """
+        if self.restart_queue:
+            transaction_id = self.restart_queue.popleft()
+            is_read_only = False
+        else:
+            self.transaction_count += 1
+            transaction_id = "T{}".format(self.transaction_count)
+            is_read_only = self.rng.random() < self.read_only_ratio
+        self.active[transaction_id] = self.rng.randint(1, self.ops_per_transaction)
+        self.checker.on_begin(transaction_id, self.tm.ts, is_read_only)
+        return "{}({})".format("beginRO" if is_read_only else "begin", transaction_id)
+
+
+    def operation_line(self, transaction_id: str):
+        """
+        Let an idle transaction issue its next operation, or end it when it has done enough
+        """
+        if self.active[transaction_id] == 0:
+            self.active.pop(transaction_id)
+            return "end({})".format(transaction_id)
+        self.active[transaction_id] -= 1
+        variable_id = self.rng.choice(self.variables)
+        is_read_only = self.tm.transaction_table[TRANSACTION_IDS.index[transaction_id]].is_read_only
+        # a read-write transaction waiting for an unreadable copy keeps its locks, and this wait is invisible to
+        # deadlock detection, so like a client it writes instead of reading a variable with no readable copy
+        if not is_read_only and (self.rng.random() < self.write_ratio or not self.is_readable(variable_id)):
+            self.next_value += 1
+            return "W({}, {}, {})".format(transaction_id, variable_id, self.next_value)
+        return "R({}, {})".format(transaction_id, variable_id)
+
+
+    def is_readable(self, variable_id: str):
+        """
+        Judge whether some up site has a readable copy of a variable
+        """
+        dense_id = VARIABLE_IDS.index[variable_id]
+        return any(site.is_up and site.data_table[dense_id].is_readable for site in self.tm.replicas_of(dense_id))
+
+
+    def run(self, line_count: int, quiet = True):
+        """
+        Feed generated lines into TransactionManager
+        :param line_count: number of input lines to generate
+        :param quiet: swallow TransactionManager output
+        :return: HistoryChecker holding the checked history
+        """
+        output = NullWriter() if quiet else sys.stdout
+        with contextlib.redirect_stdout(output):
+            for _ in range(line_count):
+                try:
+                    self.tm.process_line(self.next_line())
+                except InvalidCommandError:
+                    # deadlock is solved at the start of process_line, the victim may be the one this line is about
+                    self.rejected_lines += 1
+                self.lines += 1
+        return self.checker
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Run a seeded random workload and check the committed history")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--lines", type=int, default=100000, help="number of input lines to generate")
+    parser.add_argument("--max-active", type=int, default=8)
+    parser.add_argument("--read-only-ratio", type=float, default=0.2)
+    parser.add_argument("--fail-rate", type=float, default=0.01)
+    parser.add_argument("--recover-rate", type=float, default=0.05)
+    parser.add_argument("--catch-up-budget", type=int, default=None)
+    parser.add_argument("--version-store", default=None, help="directory for cold version segments")
+    parser.add_argument("--hot-versions", type=int, default=64)
+    parser.add_argument("--first-value", type=int, default=1000, help="written values count up from here")
+    parser.add_argument("--admission-limit", type=int, default=None, help="max active read-write transactions")
+    parser.add_argument("--adaptive-admission", action="store_true")
+    parser.add_argument("--restart-aborted", action="store_true", help="begin aborted transactions again with the same id")
+    parser.add_argument("--aging", action="store_true", help="retry operations and choose deadlock victims by first begin")
+    parser.add_argument("--max-victim-aborts", type=int, default=None, help="spare deadlock victims aborted this often")
+    parser.add_argument("--restart-memory", type=int, default=DEFAULT_RESTART_MEMORY, help="aborted transactions remembered for restarts")
+    parser.add_argument("--profile", default=None, help="prefix of profile output, writes .collapsed and .speedscope.json")
+    args = parser.parse_args()
+
+    simulator = Simulator(args.seed, max_active=args.max_active, read_only_ratio=args.read_only_ratio,
+                          fail_rate=args.fail_rate, recover_rate=args.recover_rate, first_value=args.first_value,
+                          catch_up_budget=args.catch_up_budget,
+                          version_store_path=args.version_store, hot_versions=args.hot_versions,
+                          admission_limit=args.admission_limit, adaptive_admission=args.adaptive_admission,
+                          profile=args.profile is not None, restart_aborted=args.restart_aborted,
+                          aging=args.aging, max_victim_aborts=args.max_victim_aborts, restart_memory=args.restart_memory)
+    start = time.perf_counter()
+    checker = simulator.run(args.lines)
+    elapsed = time.perf_counter() - start
+
+    print("lines: {} ({} rejected), transactions: {}, committed: {}, aborted: {}, reads checked: {}, {:.1f}s".
+          format(simulator.lines, simulator.rejected_lines, simulator.transaction_count, checker.committed,
+                 checker.aborted, checker.reads_checked, elapsed))
+    if simulator.tm.admission:
+        print("admission: {}".format(simulator.tm.admission.stats()))
+    if simulator.tm.scheduler:
+        print("scheduling: {}".format(simulator.tm.scheduler.stats()))
+    if simulator.tm.profiler:
+        simulator.tm.profiler.export_collapsed(args.profile + ".collapsed")
+        simulator.tm.profiler.export_speedscope(args.profile + ".speedscope.json")
+        print(simulator.tm.profiler.report())
+    for violation in checker.violations[:20]:
+        print("VIOLATION: " + violation)
+    sys.exit(1 if checker.violations else 0)
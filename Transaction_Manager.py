@@ -1,22 +1,72 @@
 import re
+import json
 from collections import defaultdict
 from typing import List
-from Utils import InvalidCommandError, OperationType, Operation, Transaction
-from Data_Manager import DataManager
+from Utils import InvalidCommandError, OperationType, Operation, BatchOperation, Transaction, SnapshotCache, \
+    AdmissionController, StarvationScheduler, VARIABLE_IDS, TRANSACTION_IDS, DEFAULT_RESTART_MEMORY, named_graph
+from Data_Manager import DataManager, DEFAULT_HOT_VERSIONS
+from Locks import LockType, DEFAULT_ESCALATION_THRESHOLD
+from Profiler import Profiler
+
+DEFAULT_SNAPSHOT_CACHE_SIZE = 1024
 
 
 # Transaction Manager is used to process all instructions and conduct corresponding operations for various transactions
 class TransactionManager:
 
-    def __init__(self):
+    def __init__(self, escalation_threshold = DEFAULT_ESCALATION_THRESHOLD, catch_up_budget = None,
+                 snapshot_cache_size = DEFAULT_SNAPSHOT_CACHE_SIZE, version_store_path = None,
+                 hot_versions = DEFAULT_HOT_VERSIONS, admission_limit = None, adaptive_admission = False,
+                 profile = False, defer_blocked_end = False, aging = False, max_victim_aborts = None,
+                 restart_memory = DEFAULT_RESTART_MEMORY):
         """
         Initialize Transaction Manager
         Call DataManager to finish initialization of all sites
+        :param escalation_threshold: variable locks per site after which a transaction escalates to a site lock, None disables
+        :param catch_up_budget: variables each recovered site copies from peers per tick, None disables peer catch-up
+        :param snapshot_cache_size: max entries of read-only snapshot cache, 0 disables it
+        :param version_store_path: directory where older versions spill to memory-mapped segment files, None disables
+        :param hot_versions: max number of versions per variable kept in memory when version_store_path is set
+        :param admission_limit: max number of active read-write transactions, later ones wait, None admits all
+        :param adaptive_admission: adapt admission_limit to observed abort and wait rates
+        :param profile: time hot entry points per input command type, see Profiler
+        :param defer_blocked_end: end of a transaction with waiting operations is deferred until they are done,
+                                  for generated inputs which can not know whether an operation blocks
+        :param aging: retry waiting operations and choose deadlock victims by first begin time, kept over restarts
+        :param max_victim_aborts: spare a deadlock victim which has been aborted this often, None disables
+        :param restart_memory: max number of aborted transactions remembered by scheduler, a forgotten one restarts as new
         """
         self.ts = 0 # record current timestamp
-        self.transaction_table = {} # transaction table to record all transactions, {transaction_id: Transaction}
+        self.transaction_table = {} # transaction table to record all transactions, {transaction id: Transaction}
         self.operation_list = [] # all operations which wait to be executed, Read/Write, order of ops should be retained
-        self.site_list = [DataManager(site_id) for site_id in range(1,11)] # list of all sites
+        self.site_list = [DataManager(site_id, escalation_threshold, version_store_path, hot_versions)
+                          for site_id in range(1,11)] # list of all sites
+        self.replicas = [[] for _ in range(len(VARIABLE_IDS))] # sites holding each variable, indexed by variable id
+        for site in self.site_list:
+            for variable_id in site.data_table:
+                self.replicas[variable_id].append(site)
+        self.catch_up_budget = catch_up_budget
+        self.site_transaction_index = defaultdict(set) # {site id: ids of active transactions which accessed it}
+        # writes refused by some replicas, each one waits here once for what blocks it on any up replica
+        self.replica_waits = {} # {(transaction id, variable id): {site id: ids of transactions blocking it there}}
+        self.snapshot_cache = SnapshotCache(snapshot_cache_size)
+        # last time a commit, site failure or catch-up changed what a snapshot read returns
+        # read-only transactions which begin in the same epoch see the same snapshot and share cache entries
+        self.snapshot_epoch_ts = 0
+        # read-only transactions begun in this tick, a deferred end may still commit at this time,
+        # so their epoch is only taken when the tick ends
+        self.unsealed_snapshots = []
+        self.last_dump_ts = 0 # time of last structured dump, for "since last" dumps
+        self.admission = AdmissionController(admission_limit, adaptive_admission) if admission_limit else None
+        self.history = None # optional recorder with on_read / on_write / on_commit / on_abort, used by Simulator
+        self.defer_blocked_end = defer_blocked_end
+        # wait / restart accounting and starvation-aware scheduling, None keeps plain arrival order and youngest victim
+        self.scheduler = StarvationScheduler(aging, max_victim_aborts, restart_memory) \
+            if aging or max_victim_aborts is not None else None
+        self.profiler = None # instrumenting profiler, only set in profile mode
+        if profile:
+            self.profiler = Profiler()
+            self.profiler.instrument(self)
 
 
     def dump(self):
@@ -28,6 +78,63 @@ class TransactionManager:
             site.dump()
 
 
+    def dump_json(self, site_ids = None, variable_ids = None, since_ts = None):
+        """
+        Output a machine-readable dump of sites as one line of JSON
+        :param site_ids: only dump these sites, None means all sites
+        :param variable_ids: only dump these variables, None means all variables
+        :param since_ts: only dump variables changed at or after this time, None means all
+        :return: the dumped dict {"ts": current time, "sites": [...]}
+        """
+        sites = [site.dump_structured(variable_ids, since_ts) for site in self.site_list
+                 if site_ids is None or site.site_id in site_ids]
+        result = {"ts": self.ts, "sites": sites}
+        self.last_dump_ts = self.ts
+        print(json.dumps(result))
+        return result
+
+
+    def parse_dump_paras(self, paras: List[str]):
+        """
+        Parse paras of dumpJSON, e.g. dumpJSON(site 1 3, var x2 x5, range x4 x8, since 5) or dumpJSON(since last)
+        :param paras: a list of paras like [site, 1, 3, range, x4, x8, since, last]
+        :return: (site ids, variable ids, since timestamp), None means no restriction
+        """
+        site_ids, variable_ids, since_ts = None, None, None
+        keyword = None
+        range_bounds = []
+        value_counts = [] # [keyword, number of values given to it], in order of keywords
+        for para in paras:
+            if para in ("site", "var", "range", "since"):
+                keyword = para
+                value_counts.append([keyword, 0])
+                continue
+            if value_counts: value_counts[-1][1] += 1
+            try:
+                if keyword == "site":
+                    site_ids = (site_ids or set()) | {int(para)}
+                elif keyword == "var":
+                    variable_ids = (variable_ids or set()) | {self.variable_id_of(para)}
+                elif keyword == "range":
+                    range_bounds.append(int(para.lstrip('x')))
+                elif keyword == "since":
+                    since_ts = self.last_dump_ts if para == "last" else int(para)
+                else:
+                    raise InvalidCommandError("Unknown dumpJSON para: {}".format(para))
+            except ValueError:
+                raise InvalidCommandError("Invalid value of {} in dumpJSON: {}".format(keyword, para))
+        for keyword, count in value_counts:
+            if count == 0:
+                raise InvalidCommandError("{} of dumpJSON needs a value: {}".format(keyword, paras))
+        if range_bounds:
+            if len(range_bounds) != 2:
+                raise InvalidCommandError("range of dumpJSON needs 2 variables: {}".format(paras))
+            low, high = range_bounds
+            variable_ids = (variable_ids or set()) | {VARIABLE_IDS.index['x' + str(num)] for num in range(low, high + 1)
+                                                      if 'x' + str(num) in VARIABLE_IDS.index}
+        return site_ids, variable_ids, since_ts
+
+
     def process_line(self, line: str):
         """
         Parse a line and pass all paras to process_command
@@ -45,27 +152,45 @@ class TransactionManager:
         print("processing instruction {}({})".format(command,paras))
         self.process_command(command, paras)
         self.execute_operations()
+        self.catch_up()
+        if self.scheduler:
+            self.scheduler.record_waits(self.operation_list, self.transaction_table)
+        if self.admission or self.defer_blocked_end:
+            self.end_requested_transactions()
+        if self.admission:
+            self.admission.adjust()
+        self.seal_snapshots()
         self.ts += 1 # a newline in the input means time advances by one
 
 
     def process_command(self, command: str, paras: List[str]):
         """
         Do corresponding operation according to the command and paras
-        :param command: ["begin", "beginRO", "read", "write", "dump", "end", "fail", "recover"]
+        Transaction and variable names are interned to dense ids here, everything below works on the ids
+        :param command: ["begin", "beginRO", "R", "W", "MR", "MW", "dump", "dumpJSON", "end", "fail", "recover"]
         :param paras: a list of paras like [T1,x1,101]
         """
         if command == "begin":
-            self.beigin(paras[0],False)
+            self.beigin(TRANSACTION_IDS.add(paras[0]),False)
         elif command == "beginRO":
-            self.beigin(paras[0],True)
+            self.beigin(TRANSACTION_IDS.add(paras[0]),True)
         elif command == "R":
-            self.add_read_opration(paras[0],paras[1])
+            self.add_read_opration(TRANSACTION_IDS.add(paras[0]),self.variable_id_of(paras[1]))
         elif command == "W":
-            self.add_write_opration(paras[0],paras[1],int(paras[2]))
+            self.add_write_opration(TRANSACTION_IDS.add(paras[0]),self.variable_id_of(paras[1]),int(paras[2]))
+        elif command == "MR":
+            self.add_batch_read_operation(TRANSACTION_IDS.add(paras[0]),[self.variable_id_of(para) for para in paras[1:]])
+        elif command == "MW":
+            if len(paras) < 3 or len(paras) % 2 == 0:
+                raise InvalidCommandError("MW expects a transaction followed by variable, value pairs: {}".format(paras))
+            self.add_batch_write_operation(TRANSACTION_IDS.add(paras[0]),
+                                           {self.variable_id_of(paras[i]): int(paras[i+1]) for i in range(1,len(paras),2)})
         elif command == "dump":
             self.dump()
+        elif command == "dumpJSON":
+            self.dump_json(*self.parse_dump_paras(paras))
         elif command == "end":
-            self.end(paras[0])
+            self.end(TRANSACTION_IDS.add(paras[0]))
         elif command == "fail":
             self.fail(int(paras[0]))
         elif command == "recover":
@@ -74,6 +199,16 @@ class TransactionManager:
             raise InvalidCommandError("Unknown Instruction: " + command)
 
 
+    def variable_id_of(self, name: str):
+        """
+        :param name: name of a variable, like x3
+        :return: dense id of the variable, 2 for x3
+        """
+        if name not in VARIABLE_IDS.index:
+            raise InvalidCommandError("Unknown variable: {}".format(name))
+        return VARIABLE_IDS.index[name]
+
+
     def execute_operations(self):
         """
         Loop through operation set, call read/write to execute all
@@ -82,13 +217,20 @@ class TransactionManager:
         """
         if self.operation_list: print("==================================")
         success = None
-        for operation in list(self.operation_list): # operation_list can not be changed during iteration
+        # operation_list can not be changed during iteration
+        operations = self.scheduler.operation_order(self.operation_list, self.transaction_table) if self.scheduler \
+            else list(self.operation_list)
+        for operation in operations:
             cur_transaction: Transaction = self.transaction_table.get(operation.transaction_id)
             # first judge whether the transaction containing this op still exist
             if not cur_transaction:
                 self.operation_list.remove(operation)
                 print("Removed operation: {} [removed], Remaining operations: {}".format(operation, self.operation_list))
                 continue
+            # transaction still waits for admission, hold back its operations
+            if not cur_transaction.is_admitted:
+                continue
+            operation_info = repr(operation) # batch operations shrink during execution
             if operation.command == OperationType.R:
                 if cur_transaction.is_read_only:
                     success = self.read_snapshot(operation.transaction_id,operation.variable_id)
@@ -96,32 +238,41 @@ class TransactionManager:
                     success = self.read(operation.transaction_id,operation.variable_id)
             elif operation.command == OperationType.W:
                 success = self.write(operation.transaction_id,operation.variable_id,operation.value)
+            elif operation.command == OperationType.MR:
+                if cur_transaction.is_read_only:
+                    success = self.batch_read_snapshot(operation)
+                else:
+                    success = self.batch_read(operation)
+            elif operation.command == OperationType.MW:
+                success = self.batch_write(operation)
             else:
                 print("Invalid command {} in operation".format(operation.command))
 
             # Read/Write succeed, remove this operation from operation set
             if success:
                 self.operation_list.remove(operation)
+            if self.admission and not cur_transaction.is_read_only:
+                self.admission.record_attempt(bool(success))
 
             # Output execution info
             status = "success" if success else "fail"
-            print("Executed operation: {} [{}], Remaining operations: {}".format(operation, status, self.operation_list))
+            print("Executed operation: {} [{}], Remaining operations: {}".format(operation_info, status, self.operation_list))
 
         if success!=None: print("")
 
 
-    def add_read_opration(self, transaction_id: str, variable_id: str):
+    def add_read_opration(self, transaction_id: int, variable_id: int):
         """
         Add read operation to operation queue for future execution
         :param transaction_id: id of this transaction
         :param variable_id: id of variable which T wants to access
         """
         if not self.transaction_table.get(transaction_id):
-            raise InvalidCommandError("{} doesn't exist".format(transaction_id))
+            raise InvalidCommandError("{} doesn't exist".format(TRANSACTION_IDS.names[transaction_id]))
         self.operation_list.append(Operation(OperationType.R, transaction_id, variable_id))
 
 
-    def read(self, transaction_id: str, variable_id: str):
+    def read(self, transaction_id: int, variable_id: int):
         """
         A transaction T want to read a variable i
         Call DM to read from any sites which have this variable
@@ -131,17 +282,24 @@ class TransactionManager:
         """
         cur_transaction: Transaction = self.transaction_table.get(transaction_id)
         if not cur_transaction:
-            raise InvalidCommandError("{} doesn't exist".format(transaction_id))
+            raise InvalidCommandError("{} doesn't exist".format(TRANSACTION_IDS.names[transaction_id]))
 
-        for site in self.site_list:
-            if site.is_up and site.has_variable(variable_id):
+        refused_sites = []
+        for site in self.replicas_of(variable_id):
+            if site.is_up:
                 return_result = site.read(transaction_id,variable_id)
                 # read is success, update transaction's site_access list
                 if return_result.success:
-                    cur_transaction.site_access_list.append(site.site_id)
+                    # read lock queued on sites tried before is not needed anymore
+                    for refused_site in refused_sites:
+                        refused_site.cancel_queued_read(transaction_id, variable_id)
+                    self.record_site_access(cur_transaction, site.site_id)
+                    transaction_name, variable_name = TRANSACTION_IDS.names[transaction_id], VARIABLE_IDS.names[variable_id]
+                    if self.history: self.history.on_read(transaction_name, variable_name, return_result.value)
                     print("{} successfully read {} from site {}, return {}".
-                          format(transaction_id, variable_id, site.site_id,return_result.value))
+                          format(transaction_name, variable_name, site.site_id,return_result.value))
                     return True
+                refused_sites.append(site)
         return False
 
 
@@ -154,19 +312,34 @@ class TransactionManager:
         :return: True means read succeed, False means read fail
         """
         if not self.transaction_table.get(transaction_id):
-            raise InvalidCommandError("{} does not exist".format(transaction_id))
+            raise InvalidCommandError("{} does not exist".format(TRANSACTION_IDS.names[transaction_id]))
+
+        cur_transaction: Transaction = self.transaction_table[transaction_id]
+        transaction_name, variable_name = TRANSACTION_IDS.names[transaction_id], VARIABLE_IDS.names[variable_id]
+        snapshot_ts = cur_transaction.snapshot_ts
+        # entries of failed sites are invalidated, so a cached site is still up and still serves this snapshot
+        # a transaction read in the tick it begins has no snapshot_ts yet, it bypasses the cache
+        cached = self.snapshot_cache.get(variable_id, snapshot_ts) if snapshot_ts is not None else None
+        if cached:
+            value, site_id = cached
+            if self.history: self.history.on_read(transaction_name, variable_name, value)
+            print("{} (read-only) successfully read {} from site {}, return {}".format(transaction_name, variable_name, site_id, value))
+            return True
 
-        begin_ts = self.transaction_table[transaction_id].begin_time
-        for site in self.site_list:
-            if site.is_up and site.has_variable(variable_id):
+        begin_ts = cur_transaction.begin_time
+        for site in self.replicas_of(variable_id):
+            if site.is_up:
                 return_result = site.read_snapshot(variable_id, begin_ts)
                 if return_result.success:
-                    print("{} (read-only) successfully read {} from site {}, return {}".format(transaction_id, variable_id, site.site_id, return_result.value))
+                    if snapshot_ts is not None:
+                        self.snapshot_cache.put(variable_id, snapshot_ts, return_result.value, site.site_id)
+                    if self.history: self.history.on_read(transaction_name, variable_name, return_result.value)
+                    print("{} (read-only) successfully read {} from site {}, return {}".format(transaction_name, variable_name, site.site_id, return_result.value))
                     return True
         return False
 
 
-    def add_write_opration(self, transaction_id: str, variable_id: str, value: int):
+    def add_write_opration(self, transaction_id: int, variable_id: int, value: int):
         """
         Add write operation to operation queue for future execution
         :param transaction_id: id of this transaction
@@ -174,11 +347,11 @@ class TransactionManager:
         :param value: value which T wants to write to variable
         """
         if not self.transaction_table.get(transaction_id):
-            raise InvalidCommandError("{} doesn't exist".format(transaction_id))
+            raise InvalidCommandError("{} doesn't exist".format(TRANSACTION_IDS.names[transaction_id]))
         self.operation_list.append(Operation(OperationType.W, transaction_id, variable_id, value))
 
 
-    def write(self, transaction_id: str, variable_id: str, value: int):
+    def write(self, transaction_id: int, variable_id: int, value: int):
         """
         A transaction T want to write value X to a variable i
         Call DM to write to all up sites, as long as write lock can be acquired
@@ -190,25 +363,18 @@ class TransactionManager:
         """
         cur_transaction: Transaction = self.transaction_table.get(transaction_id)
         if not cur_transaction:
-            raise InvalidCommandError("{} doesn't exist".format(transaction_id))
-
-        # judge whether all relevant up sites can be written
-        can_get_all_write_lock = True
-        all_relevant_site_down = True
-        for site in self.site_list:
-            if site.is_up and site.has_variable(variable_id):
-                all_relevant_site_down = False
-                if not site.can_get_write_lock(transaction_id, variable_id):
-                    can_get_all_write_lock = False
+            raise InvalidCommandError("{} doesn't exist".format(TRANSACTION_IDS.names[transaction_id]))
 
         # all relevant up sites can be written
-        if not all_relevant_site_down and can_get_all_write_lock:
-            for site in self.site_list:
-                if site.is_up and site.has_variable(variable_id):
+        if self.acquire_replicated_write_lock(transaction_id, variable_id):
+            transaction_name, variable_name = TRANSACTION_IDS.names[transaction_id], VARIABLE_IDS.names[variable_id]
+            for site in self.replicas_of(variable_id):
+                if site.is_up:
                     site.write(transaction_id, variable_id, value)
-                    cur_transaction.site_access_list.append(site.site_id)
+                    self.record_site_access(cur_transaction, site.site_id)
                     print("{} successfully write {} to {} in site {}".
-                          format(transaction_id, variable_id, value, site.site_id))
+                          format(transaction_name, variable_name, value, site.site_id))
+            if self.history: self.history.on_write(transaction_name, variable_name, value)
             return True
 
         # at least 1 relevant up site can not be written, give up
@@ -216,7 +382,206 @@ class TransactionManager:
             return False
 
 
-    def beigin(self, transaction_id: str, is_read_only: bool):
+    def add_batch_read_operation(self, transaction_id: int, variable_ids: List[int]):
+        """
+        Add a batch read operation to operation queue, the batch is executed and retried as one unit
+        :param transaction_id: id of this transaction
+        :param variable_ids: ids of variables which T wants to read
+        """
+        if not self.transaction_table.get(transaction_id):
+            raise InvalidCommandError("{} doesn't exist".format(TRANSACTION_IDS.names[transaction_id]))
+        if not variable_ids:
+            raise InvalidCommandError("MR of {} has no variable".format(TRANSACTION_IDS.names[transaction_id]))
+        self.operation_list.append(BatchOperation(OperationType.MR, transaction_id, dict.fromkeys(variable_ids)))
+
+
+    def add_batch_write_operation(self, transaction_id: int, items: dict):
+        """
+        Add a batch write operation to operation queue, the batch is executed and retried as one unit
+        :param transaction_id: id of this transaction
+        :param items: {variable id: value which T wants to write to variable}
+        """
+        if not self.transaction_table.get(transaction_id):
+            raise InvalidCommandError("{} doesn't exist".format(TRANSACTION_IDS.names[transaction_id]))
+        self.operation_list.append(BatchOperation(OperationType.MW, transaction_id, items))
+
+
+    def batch_read(self, operation: BatchOperation):
+        """
+        A transaction T want to read several variables
+        Visit each up site once, and let it read all pending variables it has in one pass
+        Variables which are read successfully are removed from the batch
+        :param operation: the batch read operation
+        :return: True means all variables of the batch have been read, False means some are still pending
+        """
+        cur_transaction: Transaction = self.transaction_table.get(operation.transaction_id)
+        if not cur_transaction:
+            raise InvalidCommandError("{} doesn't exist".format(TRANSACTION_IDS.names[operation.transaction_id]))
+
+        transaction_name = TRANSACTION_IDS.names[operation.transaction_id]
+        refused_sites = []
+        for site in self.sites_of(operation.pending):
+            if not operation.pending: break
+            if not site.is_up: continue
+            values = site.read_batch(operation.transaction_id, list(operation.pending))
+            if values:
+                self.record_site_access(cur_transaction, site.site_id)
+            for variable_id, value in values.items():
+                operation.pending.pop(variable_id)
+                # read lock queued on sites tried before is not needed anymore
+                for refused_site in refused_sites:
+                    if refused_site.has_variable(variable_id):
+                        refused_site.cancel_queued_read(operation.transaction_id, variable_id, operation.pending)
+                if self.history: self.history.on_read(transaction_name, VARIABLE_IDS.names[variable_id], value)
+                print("{} successfully read {} from site {}, return {}".
+                      format(transaction_name, VARIABLE_IDS.names[variable_id], site.site_id, value))
+            refused_sites.append(site)
+        return not operation.pending
+
+
+    def batch_read_snapshot(self, operation: BatchOperation):
+        """
+        A read-only transaction T want to read several variables
+        :param operation: the batch read operation
+        :return: True means all variables of the batch have been read, False means some are still pending
+        """
+        for variable_id in list(operation.pending):
+            if self.read_snapshot(operation.transaction_id, variable_id):
+                operation.pending.pop(variable_id)
+        return not operation.pending
+
+
+    def batch_write(self, operation: BatchOperation):
+        """
+        A transaction T want to write several variables
+        Visit each up site once to collect write locks of all pending variables it has,
+        then write every variable whose write locks are obtained on all of its up sites
+        Variables which are written successfully are removed from the batch
+        :param operation: the batch write operation
+        :return: True means all variables of the batch have been written, False means some are still pending
+        """
+        cur_transaction: Transaction = self.transaction_table.get(operation.transaction_id)
+        if not cur_transaction:
+            raise InvalidCommandError("{} doesn't exist".format(TRANSACTION_IDS.names[operation.transaction_id]))
+
+        transaction_name = TRANSACTION_IDS.names[operation.transaction_id]
+        # one pass per site, writable variables are those granted on every relevant up site
+        sites = self.sites_of(operation.pending)
+        writable = set(operation.pending)
+        has_up_site = set()
+        refused = defaultdict(list) # {site: variables refused on this site}
+        for site in sites:
+            if not site.is_up: continue
+            relevant = [variable_id for variable_id in operation.pending if site.has_variable(variable_id)]
+            if not relevant: continue
+            has_up_site.update(relevant)
+            granted = site.check_write_locks(operation.transaction_id, relevant)
+            refused[site] = [variable_id for variable_id in relevant if variable_id not in granted]
+            writable -= set(refused[site])
+        writable &= has_up_site
+        # wait for refusing sites only after all sites have been checked, like acquire_replicated_write_lock
+        for variable_id in operation.pending:
+            if variable_id in has_up_site:
+                self.wait_for_replicas(operation.transaction_id, variable_id,
+                                       [site for site in refused if variable_id in refused[site]])
+
+        for site in sites:
+            if not site.is_up: continue
+            written = False
+            for variable_id in operation.pending:
+                if variable_id in writable and site.has_variable(variable_id):
+                    site.write(operation.transaction_id, variable_id, operation.pending[variable_id])
+                    written = True
+                    print("{} successfully write {} to {} in site {}".
+                          format(transaction_name, VARIABLE_IDS.names[variable_id], operation.pending[variable_id], site.site_id))
+            if written:
+                self.record_site_access(cur_transaction, site.site_id)
+        # in batch order, writable is a set
+        for variable_id in [variable_id for variable_id in operation.pending if variable_id in writable]:
+            if self.history: self.history.on_write(transaction_name, VARIABLE_IDS.names[variable_id], operation.pending[variable_id])
+            operation.pending.pop(variable_id)
+        return not operation.pending
+
+
+    def replicas_of(self, variable_id: int):
+        """
+        :param variable_id: id of a variable
+        :return: all sites which hold this variable, up or down, in site order
+        """
+        return self.replicas[variable_id]
+
+
+    def sites_of(self, variable_ids):
+        """
+        :param variable_ids: ids of variables
+        :return: all sites which hold any of these variables, up or down, in site order
+        """
+        site_ids = {site.site_id for variable_id in variable_ids for site in self.replicas_of(variable_id)}
+        return [self.site_list[site_id - 1] for site_id in sorted(site_ids)]
+
+
+    def record_site_access(self, transaction: Transaction, site_id: int):
+        """
+        Remember that a transaction accessed a site, in both the transaction and the per-site index
+        :param transaction: the transaction which read from or wrote to the site
+        :param site_id: id of the site
+        """
+        transaction.site_access_set.add(site_id)
+        self.site_transaction_index[site_id].add(transaction.transaction_id)
+
+
+    def forget_transaction(self, transaction_id: int):
+        """
+        Remove a finished transaction from transaction table and the per-site index
+        :param transaction_id: id of this transaction
+        """
+        transaction: Transaction = self.transaction_table.pop(transaction_id)
+        for site_id in transaction.site_access_set:
+            self.site_transaction_index[site_id].discard(transaction_id)
+        for key, blockers_of_sites in list(self.replica_waits.items()):
+            if key[0] == transaction_id:
+                self.replica_waits.pop(key)
+                continue
+            for blockers in blockers_of_sites.values():
+                blockers.discard(transaction_id)
+
+
+    def acquire_replicated_write_lock(self, transaction_id: int, variable_id: int):
+        """
+        Obtain write lock of a variable on all its up replicas
+        First check every replica without side effect, so replicas which grant it take no IX intent lock
+        for a write which does not go through. A refused write waits as one waiter of the coordinator,
+        see wait_for_replicas, every retry checks all replicas again
+        :param transaction_id: id of this transaction
+        :param variable_id: id of variable which T wants to write
+        :return: True means every up replica grants the write lock, False means write has to wait
+        """
+        replicas = [site for site in self.replicas_of(variable_id) if site.is_up]
+        if not replicas: return False
+        refusing = [site for site in replicas if not site.check_write_lock(transaction_id, variable_id)]
+        self.wait_for_replicas(transaction_id, variable_id, refusing)
+        return not refusing
+
+
+    def wait_for_replicas(self, transaction_id: int, variable_id: int, refusing):
+        """
+        Record a write refused by some replicas as one waiter, whose wait-for edges are the union of
+        blockers on all refusing replicas. The write lock is queued on the first refusing replica only,
+        which keeps FIFO order of writers there without a queued lock on every replica
+        :param transaction_id: id of this transaction
+        :param variable_id: id of variable which T wants to write
+        :param refusing: up replicas which refused the write lock, in site order, empty means the write goes through
+        """
+        if not refusing:
+            self.replica_waits.pop((transaction_id, variable_id), None)
+            return
+        self.replica_waits[(transaction_id, variable_id)] = {site.site_id: site.write_lock_blockers(transaction_id, variable_id)
+                                                             for site in refusing}
+        if not any(site.lock_table[variable_id].lock_queue.has(transaction_id, LockType.W) for site in refusing):
+            refusing[0].queue_write_lock(transaction_id, variable_id)
+
+
+    def beigin(self, transaction_id: int, is_read_only: bool):
         """
         Begin a transaction
         :param transaction_id: id of this transaction
@@ -224,31 +589,87 @@ class TransactionManager:
         """
         # Initialize this transaction with current timestamp and add it into transaction table.
         if self.transaction_table.get(transaction_id):
-            raise InvalidCommandError("{} already begins".format(transaction_id))
+            raise InvalidCommandError("{} already begins".format(TRANSACTION_IDS.names[transaction_id]))
         self.transaction_table[transaction_id] = Transaction(transaction_id, self.ts, is_read_only)
+        if is_read_only:
+            self.transaction_table[transaction_id].snapshot_ts = None
+            self.unsealed_snapshots.append(self.transaction_table[transaction_id])
+        if self.scheduler: self.scheduler.on_begin(self.transaction_table[transaction_id])
+        if self.admission and not is_read_only and not self.admission.try_admit(transaction_id, self.ts):
+            self.transaction_table[transaction_id].is_admitted = False
+            print("transaction {} waits for admission, limit {} \n".format(TRANSACTION_IDS.names[transaction_id], self.admission.limit))
+            return
 
         # print transaction begin info
         if is_read_only:
-            print("read-only transaction {} begins \n".format(transaction_id))
+            print("read-only transaction {} begins \n".format(TRANSACTION_IDS.names[transaction_id]))
         else:
-            print("transaction {} begins \n".format(transaction_id))
+            print("transaction {} begins \n".format(TRANSACTION_IDS.names[transaction_id]))
 
 
-    def end(self, transaction_id: str):
+    def seal_snapshots(self):
+        """
+        Called when a tick ends, no commit, failure or catch-up can happen at this time anymore
+        Read-only transactions begun in this tick take the current epoch as their effective snapshot timestamp
+        """
+        for transaction in self.unsealed_snapshots:
+            transaction.snapshot_ts = self.snapshot_epoch_ts
+        self.unsealed_snapshots = []
+
+
+    def end(self, transaction_id: int):
         """
         End a transaction, if the abort flag of this transaction is true, abort it. Otherwise commit it.
         :param transaction_id: id of this transaction
         """
         cur_transaction: Transaction = self.transaction_table.get(transaction_id)
         if not cur_transaction:
-            raise InvalidCommandError("{} doesn't exist".format(transaction_id))
+            raise InvalidCommandError("{} doesn't exist".format(TRANSACTION_IDS.names[transaction_id]))
+        if not cur_transaction.is_admitted:
+            cur_transaction.end_requested = True
+            print("{} waits for admission, end is deferred \n".format(TRANSACTION_IDS.names[transaction_id]))
+            return
+        if self.defer_blocked_end and self.has_waiting_operation(transaction_id):
+            cur_transaction.end_requested = True
+            print("{} has waiting operations, end is deferred \n".format(TRANSACTION_IDS.names[transaction_id]))
+            return
         if cur_transaction.should_abort:
             self.abort(cur_transaction.transaction_id)
         else:
             self.commit(cur_transaction.transaction_id, self.ts)
 
 
-    def abort(self, transaction_id: str):
+    def has_waiting_operation(self, transaction_id: int):
+        """
+        :return: True if some operation of this transaction is still in operation_list
+        """
+        return any(operation.transaction_id == transaction_id for operation in self.operation_list)
+
+
+    def admit_waiting_transactions(self):
+        """
+        Admit queued transactions into free slots, they begin at admission time
+        """
+        for transaction_id in self.admission.admit_waiting(self.ts):
+            transaction: Transaction = self.transaction_table[transaction_id]
+            transaction.is_admitted = True
+            transaction.begin_time = self.ts
+            print("transaction {} admitted after waiting \n".format(TRANSACTION_IDS.names[transaction_id]))
+
+
+    def end_requested_transactions(self):
+        """
+        End admitted transactions whose end was deferred, for admission or for waiting operations, once their operations are done
+        """
+        waiting = {operation.transaction_id for operation in self.operation_list}
+        ready = [transaction for transaction in self.transaction_table.values()
+                 if transaction.end_requested and transaction.is_admitted and transaction.transaction_id not in waiting]
+        for transaction in ready:
+            self.end(transaction.transaction_id)
+        if ready: self.execute_operations()
+
+
+    def abort(self, transaction_id: int):
         """
         Call DM to abort this transaction
         update the transaction table in TM.
@@ -256,11 +677,16 @@ class TransactionManager:
         """
         for site in self.site_list:
             site.abort(transaction_id)
-        self.transaction_table.pop(transaction_id)
-        print("{} abort \n".format(transaction_id))
+        if self.scheduler: self.scheduler.on_abort(self.transaction_table[transaction_id])
+        self.forget_transaction(transaction_id)
+        if self.history: self.history.on_abort(TRANSACTION_IDS.names[transaction_id])
+        print("{} abort \n".format(TRANSACTION_IDS.names[transaction_id]))
+        if self.admission:
+            self.admission.release(transaction_id, False)
+            self.admit_waiting_transactions()
 
 
-    def commit(self, transaction_id: str, commit_ts: int):
+    def commit(self, transaction_id: int, commit_ts: int):
         """
         Call DM to commit this transaction
         update the transaction table in TM.
@@ -269,8 +695,15 @@ class TransactionManager:
         """
         for site in self.site_list:
             site.commit(transaction_id, commit_ts)
-        self.transaction_table.pop(transaction_id)
-        print("{} commit \n".format(transaction_id))
+        if not self.transaction_table[transaction_id].is_read_only:
+            self.snapshot_epoch_ts = commit_ts
+        if self.scheduler: self.scheduler.on_commit(self.transaction_table[transaction_id], commit_ts)
+        self.forget_transaction(transaction_id)
+        if self.history: self.history.on_commit(TRANSACTION_IDS.names[transaction_id], commit_ts)
+        print("{} commit \n".format(TRANSACTION_IDS.names[transaction_id]))
+        if self.admission:
+            self.admission.release(transaction_id, True)
+            self.admit_waiting_transactions()
 
 
     def fail(self, site_id: int):
@@ -283,14 +716,17 @@ class TransactionManager:
 
         site = self.site_list[site_id-1]
         site.fail(self.ts)
+        self.snapshot_cache.invalidate_site(site_id)
+        self.snapshot_epoch_ts = self.ts
         print("site {} fail at time {} \n".format(site_id, self.ts))
-        for transaction in self.transaction_table.values():
+        # only transactions which ever accessed this site are visited, in the order they began
+        affected = [self.transaction_table[transaction_id] for transaction_id in self.site_transaction_index.pop(site_id, ())]
+        for transaction in sorted(affected, key=lambda transaction: transaction.begin_time):
             # skip read-only T and already to be aborted T
             if transaction.is_read_only or transaction.should_abort:
                 continue
-            if site_id in transaction.site_access_list:
-                transaction.should_abort = True
-                print("Set transaction {}'s should_abort flag to True\n".format(transaction.transaction_id))
+            transaction.should_abort = True
+            print("Set transaction {}'s should_abort flag to True\n".format(TRANSACTION_IDS.names[transaction.transaction_id]))
 
 
     def recover(self, site_id: int):
@@ -307,9 +743,58 @@ class TransactionManager:
         print("site {} recover at time {} \n".format(site_id, self.ts))
 
 
+    def catch_up(self):
+        """
+        Background step after each instruction, let recovered sites copy missed commits from up peers
+        Waiting operations are retried if some variable became readable
+        """
+        if self.catch_up_budget is None: return
+        caught_up = 0
+        for site in self.site_list:
+            if site.is_up and site.catch_up_queue:
+                caught_up += site.catch_up(self.site_list, self.ts, self.catch_up_budget)
+        if caught_up:
+            self.snapshot_epoch_ts = self.ts
+            self.execute_operations()
+
+
+    def catch_up_stats(self):
+        """
+        Collect catch-up metrics of all recovered sites
+        :return: {site id: (versions copied, catch-up latency in ticks or None if still catching up)}
+        """
+        return {site.site_id: (site.catch_up_versions_copied, site.catch_up_latency())
+                for site in self.site_list if site.recover_time_list}
+
+
+    def collect_wait_for_graph(self):
+        """
+        Union of waits-for graphs of all up sites, and of refused replicated writes waiting at coordinator
+        :return: {transaction id: ids of transactions it waits for}
+        """
+        global_graph = defaultdict(set)
+        for site in self.site_list:
+            if site.is_up:
+                cur_graph = site.get_wait_for_graph()
+                for node, wait_set in cur_graph.items():
+                    global_graph[node] |= wait_set
+        for (transaction_id, _), blockers_of_sites in self.replica_waits.items():
+            for site_id, blockers in blockers_of_sites.items():
+                if self.site_list[site_id - 1].is_up and blockers:
+                    global_graph[transaction_id] |= blockers
+        return global_graph
+
+
+    def victim_priority(self, transaction: Transaction):
+        """
+        :return: comparable priority, the transaction with the largest one in a deadlock cycle is aborted
+        """
+        return self.scheduler.victim_priority(transaction) if self.scheduler else transaction.begin_time
+
+
     def solve_deadlock(self):
         """
-        Detect global deadlock and solve by aborting youngest transaction
+        Detect global deadlock and solve by aborting youngest transaction, or the one chosen by scheduler policy
         :return: True means deadlock detected, a transaction is aborted. False means no deadlock and no action happened.
         """
 
@@ -322,15 +807,8 @@ class TransactionManager:
                     if dfs(nei, target): return True
             return False
 
-        # collect waits-for graphs from all sites
-        global_graph = defaultdict(set)
-        for site in self.site_list:
-            if site.is_up:
-                cur_graph = site.get_wait_for_graph()
-                for node, wait_set in cur_graph.items():
-                    global_graph[node] |= wait_set
-
-        if len(global_graph.keys())>0: print("current global wait-for graph is {} \n".format(global_graph))
+        global_graph = self.collect_wait_for_graph()
+        if len(global_graph.keys())>0: print("current global wait-for graph is {} \n".format(named_graph(global_graph)))
         # detect possible cycle in global graph
         youngest_transaction = None
         for start_node in list(global_graph.keys()):
@@ -338,12 +816,12 @@ class TransactionManager:
             # if we can start from this node and return to this node, this node is a member of cycle
             if dfs(start_node, start_node):
                 transaction_in_cycle : Transaction = self.transaction_table[start_node]
-                if not youngest_transaction or transaction_in_cycle.begin_time > youngest_transaction.begin_time:
+                if not youngest_transaction or self.victim_priority(transaction_in_cycle) > self.victim_priority(youngest_transaction):
                     youngest_transaction = transaction_in_cycle
 
         # youngest_transaction found, abort it
         if youngest_transaction:
-            print("Detected deadlock, abort transaction {}".format(youngest_transaction.transaction_id))
+            print("Detected deadlock, abort transaction {}".format(TRANSACTION_IDS.names[youngest_transaction.transaction_id]))
             self.abort(youngest_transaction.transaction_id)
             return True
         return False
@@ -1,4 +1,7 @@
+import mmap
+import struct
 from enum import Enum, unique
+from collections import OrderedDict, defaultdict, deque
 
 
 #####################################################################
@@ -17,9 +20,100 @@ class CommitValue:
         self.commit_ts = commit_ts # commit timestamp of this value
 
 
+class VersionSegment:
+
+    RECORD = struct.Struct("<qq") # (commit timestamp, value), both int64
+    VALUE_MIN, VALUE_MAX = -2**63, 2**63 - 1 # range of a value stored in a record
+
+    def __init__(self, path: str):
+        """
+        Initialize VersionSegment Object, an append-only file of cold CommitValues sorted by commit timestamp
+        Lookups binary search a read-only memory map of the file, the map is renewed after appends
+        Input values are unbounded ints, a value beyond int64 stays in memory, its record only keeps its position
+        :param path: file path of this segment, an existing file is truncated
+        """
+        self.path = path
+        self.count = 0 # number of records in this segment
+        self.map = None # mmap of the file, None when stale
+        self.wide_values = {} # {record index: value which doesn't fit in int64}
+        self.hits = 0 # number of snapshot lookups answered by this segment
+        open(self.path, "wb").close()
+
+
+    def append(self, commit_values):
+        """
+        Append CommitValues to the tail, they must be later than all records already in this segment
+        :param commit_values: list of CommitValue sorted by commit timestamp
+        """
+        with open(self.path, "ab") as f:
+            for index, commit_value in enumerate(commit_values, self.count):
+                value = commit_value.value
+                if not self.VALUE_MIN <= value <= self.VALUE_MAX:
+                    self.wide_values[index] = value
+                    value = 0
+                f.write(self.RECORD.pack(commit_value.commit_ts, value))
+        self.count += len(commit_values)
+        self.close()
+
+
+    def record(self, index: int):
+        """
+        Read the record at index
+        :return: CommitValue
+        """
+        if self.map is None:
+            with open(self.path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        commit_ts, value = self.RECORD.unpack_from(self.map, index * self.RECORD.size)
+        if self.wide_values:
+            value = self.wide_values.get(index, value)
+        return CommitValue(value, commit_ts)
+
+
+    def find_latest_before(self, ts: int):
+        """
+        Binary search the latest record with commit timestamp <= ts
+        :return: CommitValue or None if all records are later than ts
+        """
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self.record(mid).commit_ts <= ts:
+                low = mid + 1
+            else:
+                high = mid
+        if low == 0: return None
+        self.hits += 1
+        return self.record(low - 1)
+
+
+    def records_after(self, ts: int):
+        """
+        Get all records with commit timestamp > ts, in timestamp order
+        :return: list of CommitValue
+        """
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self.record(mid).commit_ts <= ts:
+                low = mid + 1
+            else:
+                high = mid
+        return [self.record(index) for index in range(low, self.count)]
+
+
+    def close(self):
+        """
+        Release the memory map, it is mapped again on next lookup
+        """
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
 class TempValue:
 
-    def __init__(self, value: int, transaction_id: str):
+    def __init__(self, value: int, transaction_id: int):
         """
         :param value: actual value
         :param transaction_id: id of transaction which writes this temp value
@@ -30,7 +124,7 @@ class TempValue:
 
 class Variable:
 
-    def __init__(self, variable_id: str, initial_value: CommitValue, is_replicated: bool):
+    def __init__(self, variable_id: int, initial_value: CommitValue, is_replicated: bool):
         """
         Initialize Variable Object
         :param variable_id: id of this variable
@@ -42,6 +136,9 @@ class Variable:
         self.is_replicated = is_replicated
         self.temp_value: TempValue = None # temporary value which has been writen but not committed
         self.is_readable = True # replicated variable (even index) not readable when site recover
+        self.catch_up_ts = -1 # last time this copy caught up from a peer, history is complete up to then
+        self.cold_segment: VersionSegment = None # older commit values spilled to disk, None means all kept in memory
+        self.hot_limit = None # max number of commit values kept in commit_queue when spilling is enabled
 
 
     def get_latest_commit_value(self):
@@ -50,7 +147,7 @@ class Variable:
         return: latest commit value of this variable (Int)
         """
         if not self.commit_queue:
-            raise RuntimeError("commit queue of {} is empty".format(self.variable_id))
+            raise RuntimeError("commit queue of {} is empty".format(VARIABLE_IDS.names[self.variable_id]))
         return self.commit_queue[-1].value
 
 
@@ -61,15 +158,58 @@ class Variable:
         :return: temp value of this variable (Int)
         """
         if self.temp_value == None:
-            raise RuntimeError("temp value of {} doesn't exist".format(self.variable_id))
+            raise RuntimeError("temp value of {} doesn't exist".format(VARIABLE_IDS.names[self.variable_id]))
         return self.temp_value.value
 
     def add_commit_value(self, commit_value):
         """
         Append the CommitValue object at the end.
+        If spilling is enabled and commit queue is too long, move its older half to the cold segment
         :param commit_value: a CommitValue object
         """
         self.commit_queue.append(commit_value)
+        if self.cold_segment and len(self.commit_queue) > self.hot_limit:
+            # spill in batches, so appends to the segment are amortized
+            spill_count = len(self.commit_queue) - self.hot_limit // 2
+            self.cold_segment.append(self.commit_queue[:spill_count])
+            self.commit_queue = self.commit_queue[spill_count:]
+
+
+    def enable_spill(self, segment_path: str, hot_limit: int):
+        """
+        Keep at most hot_limit commit values in memory, older ones go to a segment file
+        :param segment_path: file path of the cold segment of this variable
+        :param hot_limit: max number of commit values kept in memory, at least 2
+        """
+        self.cold_segment = VersionSegment(segment_path)
+        self.hot_limit = max(hot_limit, 2)
+
+
+    def get_snapshot_version(self, ts: int):
+        """
+        Get the latest commit value committed at or before ts, searching memory first and then the cold segment
+        :param ts: snapshot timestamp
+        :return: CommitValue or None if nothing was committed before ts
+        """
+        # our latest commit value exist in the tail of commit queue
+        for commit_value in reversed(self.commit_queue):
+            if commit_value.commit_ts <= ts:
+                return commit_value
+        if self.cold_segment:
+            return self.cold_segment.find_latest_before(ts)
+        return None
+
+
+    def versions_after(self, ts: int):
+        """
+        Get all commit values committed after ts, in timestamp order
+        :param ts: timestamp
+        :return: list of CommitValue
+        """
+        hot = [commit_value for commit_value in self.commit_queue if commit_value.commit_ts > ts]
+        if self.cold_segment and len(hot) == len(self.commit_queue):
+            return self.cold_segment.records_after(ts) + hot
+        return hot
 
 
 class RW_Result:
@@ -84,10 +224,117 @@ class RW_Result:
         self.value = value
 
 
+class SnapshotCache:
+
+    def __init__(self, capacity: int):
+        """
+        Initialize SnapshotCache Object, an LRU cache of read-only snapshot reads
+        Key is (variable id, effective snapshot timestamp), value is (read value, id of site which served it)
+        :param capacity: max number of cached entries, least recently used entries are evicted beyond it
+        """
+        self.capacity = capacity
+        self.entries = OrderedDict() # {(variable id, snapshot ts): (value, site id)}
+        self.site_keys = defaultdict(set) # {site id: keys of entries served by this site}
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, variable_id: int, snapshot_ts: int):
+        """
+        Look up a snapshot read
+        :return: (value, site id) or None if not cached
+        """
+        key = (variable_id, snapshot_ts)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+
+    def put(self, variable_id: int, snapshot_ts: int, value: int, site_id: int):
+        """
+        Cache a successful snapshot read, evict least recently used entry when full
+        """
+        if self.capacity <= 0: return
+        key = (variable_id, snapshot_ts)
+        self.entries[key] = (value, site_id)
+        self.entries.move_to_end(key)
+        self.site_keys[site_id].add(key)
+        while len(self.entries) > self.capacity:
+            old_key, (_, old_site_id) = self.entries.popitem(last=False)
+            self.site_keys[old_site_id].discard(old_key)
+
+
+    def invalidate_site(self, site_id: int):
+        """
+        Drop all entries served by a site, called when the site fails
+        """
+        for key in self.site_keys.pop(site_id, ()):
+            self.entries.pop(key, None)
+
+
 #####################################################################
 ################### Utils for Transaction Manager ###################
 #####################################################################
 
+class IdTable:
+
+    def __init__(self, names = ()):
+        """
+        Initialize IdTable Object, it maps names like T3 or x12 to dense integers
+        Input names are interned once when a line is parsed, the engine keys all its tables by the integers,
+        names only come back when something is printed, dumped or passed to a history recorder
+        :param names: names to register, in order of their dense integers
+        """
+        self.index = {} # {name: dense integer}
+        self.names = [] # names, indexed by dense integer
+        for name in names:
+            self.add(name)
+
+
+    def add(self, name: str):
+        """
+        Register a name if it is new
+        :return: dense integer of this name
+        """
+        if name not in self.index:
+            self.index[name] = len(self.names)
+            self.names.append(name)
+        return self.index[name]
+
+
+    def names_of(self, dense_ids):
+        """
+        :return: set of names of dense integers
+        """
+        return {self.names[dense_id] for dense_id in dense_ids}
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+# ids of all variables, x1 is 0 and x20 is 19
+VARIABLE_IDS = IdTable("x{}".format(num) for num in range(1, 21))
+# ids of transactions, registered at first sight, a transaction which begins again with the same name gets the same id
+TRANSACTION_IDS = IdTable()
+
+
+def named_graph(graph: dict):
+    """
+    Translate a waits-for graph of dense transaction ids into names, for output
+    :param graph: {transaction id: ids of transactions it waits for}
+    :return: defaultdict {transaction name: names of transactions it waits for}
+    """
+    result = defaultdict(set)
+    for node, wait_set in graph.items():
+        result[TRANSACTION_IDS.names[node]] = TRANSACTION_IDS.names_of(wait_set)
+    return result
+
+
 class InvalidCommandError(Exception):
     """Error thrown for invalid commands"""
 
@@ -99,11 +346,13 @@ class InvalidCommandError(Exception):
 class OperationType(Enum):
     R = 0
     W = 1
+    MR = 2
+    MW = 3
 
 
 class Operation:
 
-    def __init__(self, command: OperationType, transaction_id: str, variable_id: str, value: int = None):
+    def __init__(self, command: OperationType, transaction_id: int, variable_id: int, value: int = None):
         """
         Initialize an operation, the operation type is only Read/Write
         :param command: R or W indicating the operation type
@@ -122,14 +371,43 @@ class Operation:
         Output operation object info
         """
         if self.value:
-            return "{} ({}, {}, {})".format(self.command, self.transaction_id, self.variable_id, self.value)
+            return "{} ({}, {}, {})".format(self.command, TRANSACTION_IDS.names[self.transaction_id],
+                                            VARIABLE_IDS.names[self.variable_id], self.value)
+        else:
+            return "{} ({}, {})".format(self.command, TRANSACTION_IDS.names[self.transaction_id],
+                                        VARIABLE_IDS.names[self.variable_id])
+
+
+class BatchOperation(Operation):
+
+    def __init__(self, command: OperationType, transaction_id: int, items: dict):
+        """
+        Initialize a batch operation, the operation type is only MR/MW
+        A batch stays in operation queue as one unit, variables which succeed are removed from it
+        :param command: MR or MW indicating the operation type
+        :param transaction_id: id of this transaction
+        :param items: {variable id: write value}, write value is None for MR
+        """
+        super().__init__(command, transaction_id, None)
+        self.items = dict(items) # all variables of this batch, keep the order given in command
+        self.pending = dict(items) # variables which have not succeeded yet
+
+
+    def __repr__(self):
+        """
+        Output batch operation object info, only pending variables are shown
+        """
+        if self.command == OperationType.MW:
+            paras = ", ".join("{}, {}".format(VARIABLE_IDS.names[variable_id], value)
+                              for variable_id, value in self.pending.items())
         else:
-            return "{} ({}, {})".format(self.command, self.transaction_id, self.variable_id)
+            paras = ", ".join(VARIABLE_IDS.names[variable_id] for variable_id in self.pending)
+        return "{} ({}, {})".format(self.command, TRANSACTION_IDS.names[self.transaction_id], paras)
 
 
 class Transaction:
 
-    def __init__(self, transaction_id: str, begin_time: int, is_read_only: bool):
+    def __init__(self, transaction_id: int, begin_time: int, is_read_only: bool):
         """
         Initialize a Transaction
         :param transaction_id: id of this transaction
@@ -140,7 +418,13 @@ class Transaction:
         self.begin_time = begin_time
         self.is_read_only = is_read_only
         self.should_abort = False
-        self.site_access_list = []
+        self.snapshot_ts = begin_time # effective snapshot timestamp of read-only transaction, set by TM when its begin tick ends
+        self.is_admitted = True # False while waiting in admission queue, its operations are held back
+        self.end_requested = False # end was deferred (admission or waiting operations), transaction ends once its operations are done
+        self.site_access_set = set() # ids of sites this transaction has read from or written to
+        self.first_begin_time = begin_time # begin of its first run, kept when it restarts after an abort
+        self.restarts = 0 # number of times this transaction id was aborted and began again
+        self.wait_ticks = 0 # ticks in which it had a waiting operation, counted by StarvationScheduler
 
 
     def __repr__(self):
@@ -148,6 +432,207 @@ class Transaction:
         Output transaction object info
         """
         if self.is_read_only:
-            return "[{}, begin at {}, read-only]".format(self.transaction_id, self.begin_time)
+            return "[{}, begin at {}, read-only]".format(TRANSACTION_IDS.names[self.transaction_id], self.begin_time)
         else:
-            return "[{}, begin at {}]".format(self.transaction_id, self.begin_time)
+            return "[{}, begin at {}]".format(TRANSACTION_IDS.names[self.transaction_id], self.begin_time)
+
+
+class AdmissionController:
+
+    def __init__(self, limit: int, adaptive = False, min_limit = 1, max_limit = 64, window = 50,
+                 high_abort_rate = 0.2, low_abort_rate = 0.05, high_wait_rate = 0.8):
+        """
+        Initialize AdmissionController Object, it limits how many read-write transactions are active at once
+        Read-only transactions never take locks, they are always admitted
+        In adaptive mode the limit follows additive increase / multiplicative decrease on recent outcomes:
+        decrease when too many transactions abort or too many operation attempts wait, increase otherwise
+        :param limit: initial multiprogramming limit
+        :param adaptive: whether to adjust limit by observed abort and wait rates
+        :param min_limit: lower bound of adaptive limit
+        :param max_limit: upper bound of adaptive limit
+        :param window: number of recent transaction outcomes / operation attempts used for the rates
+        :param high_abort_rate: abort rate above which limit decreases
+        :param low_abort_rate: abort rate below which limit may increase
+        :param high_wait_rate: fraction of failed operation attempts above which limit decreases
+        """
+        self.limit = limit
+        self.adaptive = adaptive
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.high_abort_rate = high_abort_rate
+        self.low_abort_rate = low_abort_rate
+        self.high_wait_rate = high_wait_rate
+
+        self.active = set() # ids of admitted read-write transactions
+        self.queue = deque() # (transaction id, request timestamp) waiting for admission, FIFO
+        self.outcomes = deque(maxlen=window) # True means commit, False means abort
+        self.attempts = deque(maxlen=window) # True means operation succeeded, False means it has to wait
+        self.latencies = [] # admission latency of every admitted transaction, in ticks
+
+
+    def try_admit(self, transaction_id: int, request_ts: int):
+        """
+        Admit a read-write transaction if there is a free slot and nobody is queued before it, otherwise queue it
+        :return: True means admitted now
+        """
+        if not self.queue and len(self.active) < self.limit:
+            self.active.add(transaction_id)
+            self.latencies.append(0)
+            return True
+        self.queue.append((transaction_id, request_ts))
+        return False
+
+
+    def release(self, transaction_id: int, committed: bool):
+        """
+        A read-write transaction finished, free its slot
+        """
+        if transaction_id in self.active:
+            self.active.remove(transaction_id)
+            self.outcomes.append(committed)
+
+
+    def record_attempt(self, success: bool):
+        """
+        Record the result of one operation attempt, used as wait rate
+        """
+        self.attempts.append(success)
+
+
+    def admit_waiting(self, ts: int):
+        """
+        Admit queued transactions while there are free slots
+        :param ts: current timestamp
+        :return: list of admitted transaction ids, in queue order
+        """
+        admitted = []
+        while self.queue and len(self.active) < self.limit:
+            transaction_id, request_ts = self.queue.popleft()
+            self.active.add(transaction_id)
+            self.latencies.append(ts - request_ts)
+            admitted.append(transaction_id)
+        return admitted
+
+
+    def adjust(self):
+        """
+        Adapt limit to recent abort and wait rates, called once per tick
+        """
+        if not self.adaptive or not self.outcomes: return
+        abort_rate = self.outcomes.count(False) / len(self.outcomes)
+        wait_rate = self.attempts.count(False) / len(self.attempts) if self.attempts else 0
+        if abort_rate > self.high_abort_rate or wait_rate > self.high_wait_rate:
+            self.limit = max(self.min_limit, int(self.limit * 0.75))
+            self.outcomes.clear()
+            self.attempts.clear()
+        elif abort_rate < self.low_abort_rate and len(self.active) >= self.limit:
+            self.limit = min(self.max_limit, self.limit + 1)
+
+
+    def stats(self):
+        """
+        :return: dict of current limit, active / queued transactions and admission latency
+        """
+        latencies = sorted(self.latencies)
+        return {"limit": self.limit, "active": len(self.active), "queued": len(self.queue),
+                "admitted": len(latencies),
+                "mean_latency": sum(latencies) / len(latencies) if latencies else 0,
+                "p99_latency": latencies[int(len(latencies) * 0.99)] if latencies else 0,
+                "max_latency": latencies[-1] if latencies else 0}
+
+
+# aborted transactions remembered for a restart, older ones are forgotten and restart as new transactions
+DEFAULT_RESTART_MEMORY = 1024
+
+
+class StarvationScheduler:
+
+    def __init__(self, aging = False, max_victim_aborts = None, restart_memory = DEFAULT_RESTART_MEMORY):
+        """
+        Initialize StarvationScheduler Object, it keeps transactions which restart after aborts from starving
+        A transaction which begins again with the id of an aborted one is a restart, it keeps its first begin time
+        :param aging: retry waiting operations and choose deadlock victims by first begin time, so priority grows with age
+        :param max_victim_aborts: a transaction aborted this often is spared as deadlock victim if the cycle has
+                                  another candidate, None never spares
+        :param restart_memory: max number of aborted transactions remembered, most of them never restart
+        """
+        self.aging = aging
+        self.max_victim_aborts = max_victim_aborts
+        self.restart_memory = restart_memory
+        # {transaction id: (first begin time, restarts)} of aborted transactions which may restart, oldest abort first
+        self.aborted = OrderedDict()
+        self.waits = [] # wait ticks of every committed transaction
+        self.restarts = [] # restarts of every committed transaction
+        self.latencies = [] # ticks from first begin to commit of every committed transaction
+
+
+    def on_begin(self, transaction: Transaction):
+        """
+        Carry first begin time and restart count over from an aborted run with the same id
+        """
+        if transaction.transaction_id in self.aborted:
+            transaction.first_begin_time, restarts = self.aborted.pop(transaction.transaction_id)
+            transaction.restarts = restarts + 1
+
+
+    def on_abort(self, transaction: Transaction):
+        """
+        Remember first begin time and restart count of an aborted read-write transaction, in case it restarts
+        Only the latest restart_memory aborts are kept, the oldest one is forgotten first
+        """
+        if transaction.is_read_only: return
+        self.aborted[transaction.transaction_id] = (transaction.first_begin_time, transaction.restarts)
+        while len(self.aborted) > self.restart_memory:
+            self.aborted.popitem(last=False)
+
+
+    def on_commit(self, transaction: Transaction, commit_ts: int):
+        """
+        Record wait ticks, restarts and latency since first begin of a committed transaction
+        """
+        self.waits.append(transaction.wait_ticks)
+        self.restarts.append(transaction.restarts)
+        self.latencies.append(commit_ts - transaction.first_begin_time)
+
+
+    def record_waits(self, operation_list: list, transaction_table: dict):
+        """
+        Called once per tick, count one wait tick for every transaction with a waiting operation
+        """
+        for transaction_id in {operation.transaction_id for operation in operation_list}:
+            if transaction_id in transaction_table:
+                transaction_table[transaction_id].wait_ticks += 1
+
+
+    def operation_order(self, operation_list: list, transaction_table: dict):
+        """
+        Order in which waiting operations are retried
+        With aging, operations of transactions which first began earlier go first,
+        the sort is stable, so operations of one transaction keep their order
+        """
+        if not self.aging: return list(operation_list)
+        def first_begin_time(operation):
+            transaction = transaction_table.get(operation.transaction_id)
+            return transaction.first_begin_time if transaction else -1
+        return sorted(operation_list, key=first_begin_time)
+
+
+    def victim_priority(self, transaction: Transaction):
+        """
+        The transaction with the largest priority in a deadlock cycle is aborted
+        """
+        spared = self.max_victim_aborts is not None and transaction.restarts >= self.max_victim_aborts
+        return not spared, transaction.first_begin_time if self.aging else transaction.begin_time
+
+
+    def stats(self):
+        """
+        :return: dict of p50 / p99 / max of wait ticks, restarts and latency of committed transactions
+        """
+        result = {"committed": len(self.latencies)}
+        for name, values in (("wait", self.waits), ("restarts", self.restarts), ("latency", self.latencies)):
+            values = sorted(values)
+            result["p50_" + name] = values[len(values) // 2] if values else 0
+            result["p99_" + name] = values[int(len(values) * 0.99)] if values else 0
+            result["max_" + name] = values[-1] if values else 0
+        return result
@@ -1,6 +1,7 @@
 import os
 import sys
 from Transaction_Manager import TransactionManager
+from Regression import TEST_CASE_OPTIONS
 
 
 if __name__ == '__main__':
@@ -22,7 +23,7 @@ if __name__ == '__main__':
             print("########################################################################")
 
             # begin to process commands in 1 input file
-            ts_manager = TransactionManager()
+            ts_manager = TransactionManager(**TEST_CASE_OPTIONS.get(file, {}))
             for line in f.readlines():
                 line = line.strip()
                 if line and not line.startswith(("#","//")):